@@ -0,0 +1,410 @@
+import os
+
+# Проверка идет без окна и звука: переменные нужно задать до импорта pygame
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import importlib
+import json
+import pickle
+import random
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import snake
+
+# Поля снимка Game.snapshot() по порядку
+FIELDS = ("snake1", "snake2", "dir1", "dir2", "food", "score1", "score2", "winner", "game_over", "rng")
+DIRECTIONS = list(snake.KEY_DIRECTIONS.values())
+COLS = snake.BOARD_WIDTH // snake.SNAKE_BLOCK
+TOP = snake.GAME_AREA_TOP // snake.SNAKE_BLOCK
+ROWS = snake.BOARD_HEIGHT // snake.SNAKE_BLOCK
+# Сколько падений на пачку случаев уменьшать и сохранять
+MAX_FAILURES = 3
+
+
+def load_engine(path):
+    # Класс движка по строке "модуль:Класс"; нужен интерфейс snake.Game
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def inside(cell):
+    # Клетка в пределах поля (в клетках, ряды считаются от верха экрана)
+    return 0 <= cell[0] < COLS and TOP <= cell[1] < ROWS
+
+
+def to_pixels(cell):
+    return [cell[0] * snake.SNAKE_BLOCK, cell[1] * snake.SNAKE_BLOCK]
+
+
+def grow_body(rng, head, length, occupied):
+    # Тело случайным блужданием от головы к хвосту; голова — последний элемент
+    body = [head]
+    while len(body) < length:
+        x, y = body[0]
+        options = [c for c in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1))
+                   if inside(c) and c not in occupied and c not in body]
+        if not options:
+            break
+        body.insert(0, rng.choice(options))
+    return body
+
+
+def random_head(rng, occupied):
+    # Голова у границы (в том числе у GAME_AREA_TOP) чаще, чем случайно
+    for _ in range(100):
+        if rng.random() < 0.4:
+            side = rng.randrange(4)
+            x = rng.randrange(COLS) if side < 2 else (0 if side == 2 else COLS - 1)
+            y = rng.randrange(TOP, ROWS) if side >= 2 else (TOP if side == 0 else ROWS - 1)
+        else:
+            x, y = rng.randrange(COLS), rng.randrange(TOP, ROWS)
+        if (x, y) not in occupied:
+            return (x, y)
+    return None
+
+
+def toward_border(rng, head):
+    # У границы в половине случаев направление в нее, иначе случайное
+    x, y = head
+    toward = [step for step, near in (((0, -1), y == TOP), ((0, 1), y == ROWS - 1),
+                                      ((-1, 0), x == 0), ((1, 0), x == COLS - 1)) if near]
+    if toward and rng.random() < 0.5:
+        return rng.choice(toward)
+    return rng.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+
+
+def head_on(rng):
+    # Две змейки на одной линии лицом друг к другу; еда иногда в клетке встречи
+    vertical = rng.random() < 0.5
+    gap = rng.choice((1, 2))
+    span = (ROWS - TOP) if vertical else COLS
+    a = rng.randrange(0, span - gap)
+    line = rng.randrange(COLS) if vertical else rng.randrange(TOP, ROWS)
+    cell = (lambda i: (line, TOP + i)) if vertical else (lambda i: (i, line))
+    body1 = [cell(i) for i in range(max(0, a - rng.randrange(5)), a + 1)]
+    body2 = [cell(i) for i in range(min(span - 1, a + gap + rng.randrange(5)), a + gap - 1, -1)]
+    step = (0, 1) if vertical else (1, 0)
+    food = cell(a + 1) if rng.random() < 0.5 else None
+    return body1, body2, step, (-step[0], -step[1]), food
+
+
+def random_state(rng):
+    # Начальное состояние матча с уклоном в пограничные ситуации
+    kind = rng.random()
+    if kind < 0.3:
+        # Обычный старт матча, как у сервера
+        return snake.Game(random.Random(rng.random())).snapshot()
+    if kind < 0.5:
+        body1, body2, d1, d2, food = head_on(rng)
+    else:
+        occupied = set()
+        head1 = random_head(rng, occupied)
+        body1 = grow_body(rng, head1, rng.choice((1, 1, 2, 5, 15, 40)), occupied)
+        occupied.update(body1)
+        head2 = random_head(rng, occupied)
+        body2 = grow_body(rng, head2, rng.choice((1, 1, 2, 5, 15, 40)), occupied)
+        d1, d2 = toward_border(rng, body1[-1]), toward_border(rng, body2[-1])
+        food = None
+        # Еда прямо перед головой: поедание на том же тике, что и столкновение
+        if rng.random() < 0.5:
+            head = body1[-1] if rng.random() < 0.5 else body2[-1]
+            step = d1 if head == body1[-1] else d2
+            ahead = (head[0] + step[0], head[1] + step[1])
+            if inside(ahead) and ahead not in body1 and ahead not in body2:
+                food = ahead
+    while food is None or food in body1 or food in body2:
+        food = (rng.randrange(COLS), rng.randrange(TOP, ROWS))
+    return (
+        [to_pixels(c) for c in body1],
+        [to_pixels(c) for c in body2],
+        [d1[0] * snake.SNAKE_BLOCK, d1[1] * snake.SNAKE_BLOCK],
+        [d2[0] * snake.SNAKE_BLOCK, d2[1] * snake.SNAKE_BLOCK],
+        to_pixels(food),
+        rng.randrange(3), rng.randrange(3), None, False,
+        random.Random(rng.random()).getstate(),
+    )
+
+
+def random_inputs(rng, ticks, used):
+    # Нажатия по тикам по мере надобности (случай обычно кончается раньше);
+    # выданное копится в used для уменьшения. Иногда несколько нажатий
+    # за тик, чтобы заполнить очередь ввода
+    for _ in range(ticks):
+        presses = []
+        for player in (1, 2):
+            if rng.random() < 0.25:
+                count = rng.choice((1, 1, 1, 2, 4))
+                presses.extend((player, rng.choice(DIRECTIONS)) for _ in range(count))
+        used.append(presses)
+        yield presses
+
+
+def make_game(engine, snapshot):
+    # Движок в заданном состоянии
+    game = engine(random.Random(0))
+    game.restore(snapshot)
+    return game
+
+
+def encode(game):
+    # Кадр состояния так, как он уйдет по сети
+    if hasattr(game, "encode_state"):
+        return game.encode_state()
+    return snake.encode_message(game.game_state())
+
+
+def compare(ref, cand, rng=True):
+    # Список расходящихся полей полного состояния (пустой, если совпадают).
+    # Генератор еды сверяется не каждый тик: его состояние дорого получать,
+    # а меняется оно только вместе с едой
+    diff = [name for name in FIELDS[:-1] if getattr(ref, name) != getattr(cand, name)]
+    if rng and ref.rng.getstate() != cand.rng.getstate():
+        diff.append("rng")
+    ref_frame, cand_frame = encode(ref), encode(cand)
+    if ref_frame != cand_frame:
+        (length,) = snake.MESSAGE_HEADER.unpack_from(cand_frame)
+        if (length != len(cand_frame) - snake.MESSAGE_HEADER.size or
+                pickle.loads(cand_frame[snake.MESSAGE_HEADER.size:]) != ref.game_state()):
+            diff.append("encoding")
+    return diff
+
+
+def queue(game, player, direction):
+    # Нажатие игрока через общую очередь ввода, как у сервера
+    if player == 1:
+        snake.queue_input(game.inputs1, direction, game.dir1)
+    else:
+        snake.queue_input(game.inputs2, direction, game.dir2)
+
+
+def run_case(reference, candidate, snapshot, inputs, stats=None):
+    # Прогон обоих движков тик за тиком; (тик, поля) при расхождении или None
+    tick = -1
+    try:
+        ref = make_game(reference, snapshot)
+        cand = make_game(candidate, snapshot)
+        diff = compare(ref, cand)
+        if diff:
+            return -1, diff
+        for tick, presses in enumerate(inputs):
+            for player, direction in presses:
+                queue(ref, player, direction)
+                queue(cand, player, direction)
+            scores = ref.score1 + ref.score2
+            food = ref.food
+            ref.step()
+            cand.step()
+            if stats is not None:
+                stats["ticks"] += 1
+            diff = compare(ref, cand, ref.food != food or cand.food != food or ref.game_over)
+            if diff:
+                return tick, diff
+            if ref.game_over:
+                if stats is not None:
+                    record_edges(stats, ref, scores)
+                break
+        diff = compare(ref, cand)
+        if diff:
+            return tick, diff
+    except Exception as e:
+        return tick, [f"exception: {e!r}"]
+    return None
+
+
+def record_edges(stats, game, scores):
+    # Учет покрытых пограничных случаев по эталонному движку
+    if game.winner == "Ничья":
+        stats["draws"] += 1
+    if game.score1 + game.score2 > scores:
+        stats["eat_and_collide"] += 1
+    for body in (game.snake1, game.snake2):
+        if body[-1][1] < snake.GAME_AREA_TOP:
+            stats["top_border"] += 1
+
+
+def flatten(inputs):
+    return [(tick, player, direction) for tick, presses in enumerate(inputs) for player, direction in presses]
+
+
+def rebuild(events, ticks):
+    inputs = [[] for _ in range(ticks)]
+    for tick, player, direction in events:
+        inputs[tick].append((player, direction))
+    return inputs
+
+
+def shrink(reference, candidate, snapshot, inputs):
+    # Уменьшение падающего случая: короче ввод, меньше нажатий (delta debugging),
+    # короче змейки и нулевой счет, пока расхождение сохраняется
+    def failing(snap, events, ticks):
+        return run_case(reference, candidate, snap, rebuild(events, ticks)) is not None
+
+    tick, _ = run_case(reference, candidate, snapshot, inputs)
+    ticks = max(tick, 0) + 1
+    events = [e for e in flatten(inputs) if e[0] < ticks]
+
+    changed = True
+    while changed:
+        changed = False
+        chunks = 2
+        while events:
+            size = max(1, len(events) // chunks)
+            for start in range(0, len(events), size):
+                trial = events[:start] + events[start + size:]
+                if failing(snapshot, trial, ticks):
+                    events = trial
+                    chunks = max(chunks - 1, 2)
+                    changed = True
+                    break
+            else:
+                if size == 1:
+                    break
+                chunks = min(len(events), chunks * 2)
+
+        for index in (0, 1):
+            while len(snapshot[index]) > 1:
+                trial = list(snapshot)
+                trial[index] = snapshot[index][1:]
+                trial = tuple(trial)
+                if not failing(trial, events, ticks):
+                    break
+                snapshot = trial
+                changed = True
+        if snapshot[5] or snapshot[6]:
+            trial = snapshot[:5] + (0, 0) + snapshot[7:]
+            if failing(trial, events, ticks):
+                snapshot = trial
+                changed = True
+
+        tick, _ = run_case(reference, candidate, snapshot, rebuild(events, ticks))
+        if max(tick, 0) + 1 < ticks:
+            ticks = max(tick, 0) + 1
+            events = [e for e in events if e[0] < ticks]
+            changed = True
+    return snapshot, rebuild(events, ticks)
+
+
+def check_batch(task):
+    # Пачка случайных случаев с общим зерном; падения уменьшаются прямо здесь
+    reference_path, candidate_path, seed, cases, max_ticks = task
+    reference, candidate = load_engine(reference_path), load_engine(candidate_path)
+    rng = random.Random(seed)
+    stats = {"cases": 0, "ticks": 0, "draws": 0, "eat_and_collide": 0, "top_border": 0, "failures": []}
+    for case in range(cases):
+        snapshot = random_state(rng)
+        inputs = []
+        stats["cases"] += 1
+        failure = run_case(reference, candidate, snapshot,
+                           random_inputs(rng, rng.randint(1, max_ticks), inputs), stats)
+        if failure and len(stats["failures"]) < MAX_FAILURES:
+            small_snapshot, small_inputs = shrink(reference, candidate, snapshot, inputs)
+            tick, diff = run_case(reference, candidate, small_snapshot, small_inputs)
+            stats["failures"].append({
+                "seed": seed,
+                "case": case,
+                "tick": tick,
+                "diff": diff,
+                "snapshot": small_snapshot,
+                "inputs": [[[player, direction] for player, direction in presses] for presses in small_inputs],
+            })
+    return stats
+
+
+def load_repro(path):
+    # Чтение сохраненного минимального случая
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    snapshot = list(data["snapshot"])
+    version, state, gauss = snapshot[9]
+    snapshot[9] = (version, tuple(state), gauss)
+    inputs = [[(player, direction) for player, direction in presses] for presses in data["inputs"]]
+    return tuple(snapshot), inputs
+
+
+def replay(reference, candidate, path):
+    # Пошаговый показ сохраненного случая
+    snapshot, inputs = load_repro(path)
+    ref, cand = make_game(reference, snapshot), make_game(candidate, snapshot)
+    print(f"старт: змейка 1 {ref.snake1} {ref.dir1}, змейка 2 {ref.snake2} {ref.dir2}, еда {ref.food}")
+    for tick, presses in enumerate(inputs):
+        for player, direction in presses:
+            queue(ref, player, direction)
+            queue(cand, player, direction)
+        ref.step()
+        cand.step()
+        diff = compare(ref, cand)
+        print(f"тик {tick}: нажатия {presses}")
+        for name, a, b in zip(FIELDS, ref.snapshot(), cand.snapshot()):
+            if name in diff:
+                print(f"  {name}: эталон {a!r}\n  {' ' * len(name)}  кандидат {b!r}")
+        if "encoding" in diff:
+            print("  кодирование состояния различается")
+        if diff:
+            return 1
+    print("Расхождений нет")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение правил сервера с альтернативным движком")
+    parser.add_argument("--candidate", required=True, help="проверяемый движок, например fastsnake:Game")
+    parser.add_argument("--reference", default="snake:Game", help="эталонный движок")
+    parser.add_argument("--ticks", type=int, default=1_000_000, help="сколько тиков прогнать всего")
+    parser.add_argument("--max-ticks", type=int, default=200, help="наибольшая длина одного случая")
+    parser.add_argument("--batch", type=int, default=500, help="случаев в одной пачке")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="число рабочих процессов")
+    parser.add_argument("--failures", default="equivalence_failures", help="папка для минимальных случаев")
+    parser.add_argument("--replay", help="показать сохраненный случай по тикам")
+    args = parser.parse_args()
+
+    if args.replay:
+        return replay(load_engine(args.reference), load_engine(args.candidate), args.replay)
+
+    # Пул закрывается через close/join: SDL перехватывает SIGTERM от terminate()
+    pool = Pool(args.workers) if args.workers > 1 else None
+    total = {"cases": 0, "ticks": 0, "draws": 0, "eat_and_collide": 0, "top_border": 0}
+    failures = []
+    started = time.perf_counter()
+    seed = args.seed
+    while total["ticks"] < args.ticks and not failures:
+        tasks = [(args.reference, args.candidate, seed + i, args.batch, args.max_ticks)
+                 for i in range(args.workers * 2)]
+        seed += len(tasks)
+        results = pool.imap_unordered(check_batch, tasks) if pool else map(check_batch, tasks)
+        for stats in results:
+            for key in total:
+                total[key] += stats[key]
+            failures.extend(stats["failures"])
+    if pool:
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"Случаев {total['cases']}, тиков {total['ticks']} за {elapsed:.1f} с "
+          f"({total['ticks'] / max(elapsed, 1e-9):.0f} тиков/с); ничьих {total['draws']}, "
+          f"поеданий в тик столкновения {total['eat_and_collide']}, "
+          f"выходов за GAME_AREA_TOP {total['top_border']}", file=sys.stderr)
+    if not failures:
+        print("Расхождений нет", file=sys.stderr)
+        return 0
+
+    out = Path(args.failures)
+    out.mkdir(exist_ok=True)
+    for failure in failures:
+        path = out / f"failure_{failure['seed']}_{failure['case']}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(failure, f, ensure_ascii=False)
+        print(f"Расхождение на тике {failure['tick']} ({', '.join(failure['diff'])}): "
+              f"{len(failure['inputs'])} тиков, змейки {len(failure['snapshot'][0])} и "
+              f"{len(failure['snapshot'][1])} клеток; {path}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,342 @@
+import os
+
+# Сервер работает без окна и звука: переменные нужно задать до импорта pygame
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import heapq
+import json
+import random
+import socket
+import sys
+import time
+from multiprocessing import Event, Pipe, Process
+
+import pygame
+
+import snake
+
+# Ход считается опоздавшим, если интервал длиннее периода на эту долю
+LATE_MARGIN = 0.1
+# Размер одного чтения быстрого клиента
+READ_CHUNK = 65536
+
+
+def rss_bytes():
+    # Резидентная память текущего процесса (Linux), иначе None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def run_server(port, pipe, stop):
+    # Безголовый сервер: тот же Server и тот же темп тиков, что в ServerMatchScene
+    server = snake.Server("127.0.0.1", port)
+    if server.error_msg:
+        pipe.send({"error": server.error_msg})
+        return
+    pipe.send({"ready": True})
+    while not server.accept_player(clear_scores=False):
+        if stop.is_set():
+            server.safe_close()
+            pipe.send({"samples": []})
+            return
+    server.start_match()
+
+    clock = pygame.time.Clock()
+    samples = []
+    last = None
+    ticks = 0
+    while not stop.is_set():
+        clock.tick(snake.FPS)
+        started = time.monotonic()
+        server.accept_pending()
+        server.check_player()
+        if not server.connection:
+            break
+        server.tick()
+        if server.game_over:
+            server.restart_game()
+        done = time.monotonic()
+
+        sample = {
+            "time": started,
+            "interval": started - last if last is not None else None,
+            "work": done - started,
+            "spectators": len(server.spectators),
+        }
+        # Очереди отправки и память опрашиваются раз в секунду, чтобы не мешать тику
+        if ticks % snake.FPS == 0:
+            sample["player_queue"] = server.connection.stats.send_queue if server.connection else None
+            # Поток ответов на пинги тоже пишет в сокеты наблюдателей
+            with server.spectators.lock:
+                spectators = server.spectators.spectators
+                sample["spectator_queue"] = sum(snake.socket_send_queue(s.sock) or 0 for s in spectators)
+                sample["spectator_pending"] = sum(len(s.pending) for s in spectators if s.pending is not None)
+                sample["frames_skipped"] = sum(s.frames_skipped for s in spectators)
+            sample["rss"] = rss_bytes()
+        samples.append(sample)
+        last = started
+        ticks += 1
+
+    server.safe_close()
+    pipe.send({"samples": samples})
+
+
+class SimClient:
+    # Соединение по протоколу Client: join, чтение с задержкой и поток вводов
+    def __init__(self, port, role, read_interval, read_bytes, rcvbuf=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.connect(("127.0.0.1", port))
+        self.connection = snake.Connection(sock)
+        self.connection.send({"join": role})
+        sock.setblocking(False)
+        self.role = role
+        self.read_interval = read_interval
+        self.read_bytes = read_bytes
+        self.input_seq = 0
+        self.inputs_blocked = 0
+        self.closed = False
+
+    def read(self):
+        # Одно чтение: медленный клиент берет не больше read_bytes за раз
+        budget = self.read_bytes
+        while budget > 0:
+            try:
+                messages = self.connection.receive(min(budget, READ_CHUNK))
+            except BlockingIOError:
+                return
+            except OSError:
+                messages = None
+            if messages is None:
+                self.close()
+                return
+            budget -= READ_CHUNK
+
+    def send_input(self, rng):
+        # Следующий ввод игрока с номером последовательности, как у Client.send_input
+        direction = rng.choice(list(snake.KEY_DIRECTIONS.values()))
+        self.input_seq += 1
+        try:
+            self.connection.send((self.input_seq, direction[0], direction[1]))
+        except BlockingIOError:
+            self.inputs_blocked += 1
+        except OSError:
+            self.close()
+
+    def close(self):
+        # Закрытие соединения
+        if not self.closed:
+            self.closed = True
+            self.connection.sock.close()
+
+
+class LoadGenerator:
+    # Все симулированные клиенты в одном процессе на общей очереди событий
+    def __init__(self, port, args):
+        self.port = port
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.clients = []
+        self.events = []
+        self.order = 0
+
+    def schedule(self, due, kind, client):
+        # Постановка события в очередь по времени
+        self.order += 1
+        heapq.heappush(self.events, (due, self.order, kind, client))
+
+    def add_client(self, role):
+        # Подключение нового клиента; часть наблюдателей читает медленно
+        args = self.args
+        slow = role == "spectator" and self.rng.random() < args.slow_readers
+        client = SimClient(self.port, role,
+                           args.slow_interval if slow else args.read_interval,
+                           args.slow_bytes if slow else sys.maxsize,
+                           args.rcvbuf)
+        self.clients.append(client)
+        now = time.monotonic()
+        self.schedule(now + self.rng.random() * client.read_interval, "read", client)
+        if role == "player" and args.input_rate > 0:
+            self.schedule(now, "input", client)
+        return client
+
+    def run_for(self, seconds):
+        # Обработка событий чтения и ввода в течение заданного времени
+        until = time.monotonic() + seconds
+        while self.events:
+            due, order, kind, client = self.events[0]
+            now = time.monotonic()
+            if due > until:
+                break
+            if due > now:
+                time.sleep(due - now)
+                continue
+            heapq.heappop(self.events)
+            if client.closed:
+                continue
+            if kind == "read":
+                client.read()
+                self.schedule(max(due + client.read_interval, now), "read", client)
+            else:
+                client.send_input(self.rng)
+                self.schedule(max(due + 1 / self.args.input_rate, now), "input", client)
+        rest = until - time.monotonic()
+        if rest > 0:
+            time.sleep(rest)
+
+    def grow_to(self, count):
+        # Подключение наблюдателей пачками не больше очереди listen сервера
+        while len(self.clients) < count:
+            for _ in range(min(snake.LISTEN_BACKLOG, count - len(self.clients))):
+                self.add_client("spectator")
+            self.run_for(0.05)
+
+    def close(self):
+        # Закрытие всех соединений
+        for client in self.clients:
+            client.close()
+
+
+def percentile(values, p):
+    # Процентиль по ближайшему рангу
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)] if values else None
+
+
+def summarize_step(target, samples, period, baseline_rss):
+    # Показатели тиков, очередей и памяти за окно одной ступени
+    intervals = [s["interval"] for s in samples if s["interval"] is not None]
+    works = [s["work"] for s in samples]
+    polled = [s for s in samples if "rss" in s]
+    duration = samples[-1]["time"] - samples[0]["time"] if len(samples) > 1 else 0
+    mean = sum(intervals) / len(intervals) if intervals else 0
+    jitter = (sum((i - mean) ** 2 for i in intervals) / len(intervals)) ** 0.5 if intervals else 0
+    spectators = samples[-1]["spectators"]
+    rss = polled[-1]["rss"] if polled else None
+    return {
+        "connections": target,
+        "spectators_connected": spectators,
+        "tick_rate": (len(samples) - 1) / duration if duration else 0,
+        "interval_ms": {
+            "mean": mean * 1000,
+            "p50": percentile(intervals, 50) * 1000 if intervals else None,
+            "p99": percentile(intervals, 99) * 1000 if intervals else None,
+            "max": max(intervals) * 1000 if intervals else None,
+        },
+        "jitter_ms": jitter * 1000,
+        "late_ticks": sum(i > period * (1 + LATE_MARGIN) for i in intervals) / max(len(intervals), 1),
+        "work_ms": {
+            "p50": percentile(works, 50) * 1000,
+            "p99": percentile(works, 99) * 1000,
+            "max": max(works) * 1000,
+        },
+        "player_queue_max": max((s["player_queue"] or 0 for s in polled), default=0),
+        "spectator_queue": [s["spectator_queue"] for s in polled],
+        "spectator_pending_max": max((s["spectator_pending"] for s in polled), default=0),
+        "frames_skipped": polled[-1]["frames_skipped"] if polled else 0,
+        "rss_mb": rss / 2 ** 20 if rss else None,
+        "rss_per_connection_kb": (rss - baseline_rss) / 1024 / spectators
+                                 if rss and baseline_rss and spectators else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка сервера множеством соединений")
+    parser.add_argument("--port", type=int, default=5599)
+    parser.add_argument("--connections", default="1,10,50,100,200",
+                        help="ступени числа наблюдателей через запятую (плюс один игрок)")
+    parser.add_argument("--step-seconds", type=float, default=5.0, help="длительность замера на ступени")
+    parser.add_argument("--settle", type=float, default=1.0, help="пауза после подключения перед замером")
+    parser.add_argument("--input-rate", type=float, default=10.0, help="вводов игрока в секунду (0 — без ввода)")
+    parser.add_argument("--read-interval", type=float, default=0.01, help="пауза между чтениями клиента, с")
+    parser.add_argument("--slow-readers", type=float, default=0.0, help="доля медленных наблюдателей (0..1)")
+    parser.add_argument("--slow-interval", type=float, default=1.0, help="пауза между чтениями медленного, с")
+    parser.add_argument("--slow-bytes", type=int, default=4096, help="байт за одно чтение медленного")
+    parser.add_argument("--rcvbuf", type=int, help="SO_RCVBUF клиентских сокетов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest.json", help="файл результатов")
+    args = parser.parse_args()
+
+    steps = sorted(int(n) for n in args.connections.split(",") if n.strip())
+    period = 1 / snake.FPS
+
+    # Сервер в отдельном процессе, чтобы генератор не отнимал у него GIL
+    parent, child = Pipe()
+    stop = Event()
+    process = Process(target=run_server, args=(args.port, child, stop), daemon=True)
+    process.start()
+    ready = parent.recv()
+    if "error" in ready:
+        print(ready["error"], file=sys.stderr)
+        process.join()
+        return 1
+
+    generator = LoadGenerator(args.port, args)
+    generator.add_client("player")
+    generator.run_for(args.settle)
+    windows = [(0, time.monotonic(), time.monotonic() + args.step_seconds)]
+    generator.run_for(args.step_seconds)
+    for target in steps:
+        generator.grow_to(target + 1)
+        generator.run_for(args.settle)
+        started = time.monotonic()
+        generator.run_for(args.step_seconds)
+        windows.append((target, started, time.monotonic()))
+        print(f"  ступень {target}: замер окончен", file=sys.stderr)
+
+    stop.set()
+    samples = parent.recv()["samples"]
+    process.join()
+    dropped = sum(c.closed for c in generator.clients if c.role == "spectator")
+    generator.close()
+
+    baseline = [s for s in samples if windows[0][1] <= s["time"] <= windows[0][2] and s.get("rss")]
+    baseline_rss = baseline[-1]["rss"] if baseline else None
+    report_steps = []
+    for target, start, end in windows:
+        window = [s for s in samples if start <= s["time"] <= end]
+        if window:
+            report_steps.append(summarize_step(target, window, period, baseline_rss))
+
+    # Первая ступень, где сервер не держит FPS тиков в секунду
+    saturation = next((s["connections"] for s in report_steps
+                       if s["tick_rate"] < snake.FPS * (1 - LATE_MARGIN)
+                       or s["interval_ms"]["p99"] > period * 1000 * (1 + 5 * LATE_MARGIN)), None)
+    report = {
+        "config": vars(args),
+        "fps": snake.FPS,
+        "cpus": os.cpu_count(),
+        "steps": report_steps,
+        "saturation_connections": saturation,
+        "inputs_sent": sum(c.input_seq for c in generator.clients),
+        "inputs_blocked": sum(c.inputs_blocked for c in generator.clients),
+        "spectators_dropped": dropped,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"{'соедин.':>8} {'тик/с':>6} {'p99 мс':>7} {'джиттер':>8} {'работа p99':>10} "
+          f"{'очередь':>8} {'пропуски':>8} {'RSS МБ':>7} {'КБ/соед.':>8}", file=sys.stderr)
+    for s in report_steps:
+        per = s["rss_per_connection_kb"]
+        print(f"{s['connections']:>8} {s['tick_rate']:>6.2f} {s['interval_ms']['p99']:>7.1f} "
+              f"{s['jitter_ms']:>8.2f} {s['work_ms']['p99']:>10.2f} {max(s['spectator_queue'], default=0):>8} "
+              f"{s['frames_skipped']:>8} {s['rss_mb'] or 0:>7.1f} {per if per is not None else 0:>8.1f}",
+              file=sys.stderr)
+    if saturation is None:
+        print(f"Сервер держит {snake.FPS} тиков в секунду на всех ступенях", file=sys.stderr)
+    else:
+        print(f"Сервер перестает держать {snake.FPS} тиков в секунду при {saturation} соединениях",
+              file=sys.stderr)
+    print(f"Результаты в {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,457 @@
+import argparse
+import heapq
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+# Сколько байт прокси держит в очереди одного направления, прежде чем
+# перестать читать (дальше растет очередь отправки у источника, как в сети)
+MAX_BUFFERED = 1 << 20
+# Задержка повторной передачи при "потере" в TCP
+RETRANSMIT_TIMEOUT = 0.2
+READ_SIZE = 65536
+
+
+class Impairment:
+    # Параметры искажения сети; меняются на лету через NetworkProxy.set()
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, loss=0.0, reorder=0.0,
+                 fragment=None, seed=None):
+        self.latency = latency        # односторонняя задержка, с
+        self.jitter = jitter          # разброс задержки, ± с
+        self.bandwidth = bandwidth    # байт в секунду в каждую сторону, None — без ограничения
+        self.loss = loss              # доля потерянных пакетов (TCP: повтор через RETRANSMIT_TIMEOUT)
+        self.reorder = reorder        # доля датаграмм, задержанных сверх очереди (только UDP)
+        self.fragment = fragment      # (от, до) байт в одной записи TCP, None — как пришло
+        self.rng = random.Random(seed)
+        self.stall_until = 0.0
+
+    def delay(self):
+        # Задержка одного пакета с учетом разброса
+        return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+
+class ProxyStats:
+    # Счетчики прокси по направлениям
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.bytes = {"up": 0, "down": 0}
+        self.packets = {"up": 0, "down": 0}
+        self.writes = {"up": 0, "down": 0}
+        self.lost = {"up": 0, "down": 0}
+        self.reordered = {"up": 0, "down": 0}
+
+    def add(self, counter, direction, value=1):
+        with self.lock:
+            getattr(self, counter)[direction] += value
+
+    def snapshot(self):
+        # Копия счетчиков
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "bytes": dict(self.bytes),
+                "packets": dict(self.packets),
+                "writes": dict(self.writes),
+                "lost": dict(self.lost),
+                "reordered": dict(self.reordered),
+            }
+
+
+class TcpPipe:
+    # Одно направление TCP-соединения: читатель ставит куски в очередь со временем
+    # доставки, писатель отдает их не раньше срока, с ограничением полосы и дроблением
+    def __init__(self, proxy, src, dst, direction, finished):
+        self.proxy = proxy
+        self.src = src
+        self.dst = dst
+        self.direction = direction
+        self.finished = finished
+        self.queue = deque()
+        self.buffered = 0
+        self.last_due = 0.0
+        self.next_free = 0.0
+        self.done = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def read_loop(self):
+        # Чтение источника; поток байтов TCP не переупорядочивается, поэтому
+        # срок доставки не раньше предыдущего, а "потеря" задерживает все следующее
+        imp = self.proxy.impairment
+        try:
+            while True:
+                with self.cond:
+                    while self.buffered > MAX_BUFFERED and not self.done:
+                        self.cond.wait()
+                data = self.src.recv(READ_SIZE)
+                if not data:
+                    break
+                due = time.perf_counter() + imp.delay()
+                if imp.loss and imp.rng.random() < imp.loss:
+                    due += RETRANSMIT_TIMEOUT
+                    self.proxy.stats.add("lost", self.direction)
+                due = max(due, self.last_due)
+                self.last_due = due
+                self.proxy.stats.add("packets", self.direction)
+                with self.cond:
+                    self.queue.append((due, data))
+                    self.buffered += len(data)
+                    self.cond.notify_all()
+        except OSError:
+            pass
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def write_loop(self):
+        # Доставка по сроку, полоса как очередь на канале, дробление на мелкие записи
+        imp = self.proxy.impairment
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.done:
+                        self.cond.wait()
+                    if not self.queue:
+                        break
+                    due, data = self.queue[0]
+                wait = max(due, imp.stall_until) - time.perf_counter()
+                if wait > 0:
+                    time.sleep(min(wait, 0.05))
+                    continue
+                with self.cond:
+                    self.queue.popleft()
+                    self.buffered -= len(data)
+                    self.cond.notify_all()
+                for piece in self.split(data):
+                    if imp.bandwidth:
+                        # Кусок уходит целиком, когда канал закончит его передавать
+                        now = time.perf_counter()
+                        self.next_free = max(now, self.next_free) + len(piece) / imp.bandwidth
+                        time.sleep(self.next_free - now)
+                    self.dst.sendall(piece)
+                    self.proxy.stats.add("writes", self.direction)
+                    self.proxy.stats.add("bytes", self.direction, len(piece))
+            # Источник закрыл свою сторону: передаем это дальше, соединение
+            # закрывается целиком, когда закончатся оба направления.
+            # После drop_connections пары уже нет, и FIN не должен обогнать RST
+            with self.proxy.lock:
+                dropped = not any(self.src in pair for pair in self.proxy.pairs)
+            if dropped:
+                return
+            self.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.proxy.close_pair(self.src, self.dst)
+            return
+        with self.proxy.lock:
+            self.finished.append(self.direction)
+            both = len(self.finished) == 2
+        if both:
+            self.proxy.close_pair(self.src, self.dst)
+
+    def split(self, data):
+        # Куски случайного размера: получатель видит сообщения по частям
+        fragment = self.proxy.impairment.fragment
+        if not fragment:
+            return [data]
+        rng = self.proxy.impairment.rng
+        pieces = []
+        pos = 0
+        while pos < len(data):
+            size = rng.randint(fragment[0], fragment[1])
+            pieces.append(data[pos:pos + size])
+            pos += size
+        return pieces
+
+
+class UdpRelay:
+    # UDP: у каждого клиента свой сокет к серверу; датаграммы задерживаются
+    # независимо, поэтому разброс и reorder действительно меняют порядок
+    def __init__(self, proxy, sock):
+        self.proxy = proxy
+        self.sock = sock
+        self.peers = {}
+        self.heap = []
+        self.order = 0
+        self.next_free = {"up": 0.0, "down": 0.0}
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.listen_loop, daemon=True).start()
+        threading.Thread(target=self.deliver_loop, daemon=True).start()
+
+    def schedule(self, data, send, direction):
+        # Постановка датаграммы в доставку или ее потеря
+        imp = self.proxy.impairment
+        self.proxy.stats.add("packets", direction)
+        if imp.loss and imp.rng.random() < imp.loss:
+            self.proxy.stats.add("lost", direction)
+            return
+        now = time.perf_counter()
+        due = now + imp.delay()
+        if imp.reorder and imp.rng.random() < imp.reorder:
+            due += imp.latency + imp.jitter + 0.01
+            self.proxy.stats.add("reordered", direction)
+        if imp.bandwidth:
+            due = max(due, self.next_free[direction]) + len(data) / imp.bandwidth
+            self.next_free[direction] = due
+        with self.cond:
+            self.order += 1
+            heapq.heappush(self.heap, (due, self.order, data, send, direction))
+            self.cond.notify()
+
+    def listen_loop(self):
+        # Датаграммы от клиентов к серверу
+        try:
+            while True:
+                data, addr = self.sock.recvfrom(READ_SIZE)
+                upstream = self.peers.get(addr)
+                if upstream is None:
+                    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    upstream.connect(self.proxy.upstream)
+                    self.peers[addr] = upstream
+                    self.proxy.stats.connections += 1
+                    threading.Thread(target=self.reply_loop, args=(upstream, addr), daemon=True).start()
+                self.schedule(data, upstream.send, "up")
+        except OSError:
+            pass
+
+    def reply_loop(self, upstream, addr):
+        # Ответы сервера одному клиенту
+        try:
+            while True:
+                data = upstream.recv(READ_SIZE)
+                self.schedule(data, lambda d: self.sock.sendto(d, addr), "down")
+        except OSError:
+            pass
+
+    def deliver_loop(self):
+        # Отправка датаграмм по сроку
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                due, order, data, send, direction = self.heap[0]
+                wait = max(due, self.proxy.impairment.stall_until) - time.perf_counter()
+                if wait > 0:
+                    self.cond.wait(min(wait, 0.05))
+                    continue
+                heapq.heappop(self.heap)
+            try:
+                send(data)
+                self.proxy.stats.add("writes", direction)
+                self.proxy.stats.add("bytes", direction, len(data))
+            except OSError:
+                pass
+
+    def close(self):
+        for upstream in self.peers.values():
+            upstream.close()
+
+
+class NetworkProxy:
+    # Локальный прокси между клиентом и сервером с искажением сети.
+    # Пример для тестов:
+    #     with NetworkProxy(("127.0.0.1", 5555), latency=0.05, jitter=0.01) as proxy:
+    #         client = Client("127.0.0.1", proxy.port)
+    #         proxy.set(loss=0.05)
+    #         proxy.stall(2.0)
+    #         proxy.drop_connections()
+    def __init__(self, upstream, listen=("127.0.0.1", 0), protocol="tcp", **impairment):
+        self.upstream = upstream
+        self.protocol = protocol
+        self.impairment = Impairment(**impairment)
+        self.stats = ProxyStats()
+        self.pairs = []
+        self.lock = threading.Lock()
+        self.relay = None
+        kind = socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM
+        self.sock = socket.socket(socket.AF_INET, kind)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(listen)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        # Запуск приема в фоновом потоке
+        if self.protocol == "tcp":
+            self.sock.listen(16)
+            threading.Thread(target=self.accept_loop, daemon=True).start()
+        else:
+            self.relay = UdpRelay(self, self.sock)
+            self.relay.start()
+        return self
+
+    def accept_loop(self):
+        # Каждое входящее соединение получает свое соединение с сервером
+        try:
+            while True:
+                client, addr = self.sock.accept()
+                try:
+                    server = socket.create_connection(self.upstream)
+                except OSError:
+                    client.close()
+                    continue
+                for s in (client, server):
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with self.lock:
+                    self.pairs.append((client, server))
+                    self.stats.connections += 1
+                finished = []
+                TcpPipe(self, client, server, "up", finished).start()
+                TcpPipe(self, server, client, "down", finished).start()
+        except OSError:
+            pass
+
+    def set(self, **changes):
+        # Изменение параметров искажения на лету
+        for name, value in changes.items():
+            if not hasattr(self.impairment, name):
+                raise AttributeError(f"Неизвестный параметр: {name}")
+            setattr(self.impairment, name, value)
+
+    def stall(self, seconds):
+        # Полная остановка доставки на время (данные копятся и приходят потом)
+        self.impairment.stall_until = time.perf_counter() + seconds
+
+    def drop_connections(self):
+        # Разрыв всех текущих TCP-соединений сбросом (RST); shutdown будит
+        # потоки, ждущие в recv(), одного close() для этого мало
+        with self.lock:
+            pairs, self.pairs = self.pairs, []
+        for pair in pairs:
+            for s in pair:
+                try:
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                    # SHUT_RD не шлет FIN, поэтому close() с нулевым linger дает RST
+                    s.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+                s.close()
+
+    def close_pair(self, a, b):
+        # Закрытие обеих сторон соединения
+        with self.lock:
+            self.pairs = [p for p in self.pairs if a not in p]
+        for s in (a, b):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+
+    def close(self):
+        # Остановка прокси
+        self.sock.close()
+        self.drop_connections()
+        if self.relay:
+            self.relay.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def parse_rate(text):
+    # "64k", "1.5m" или байты в секунду
+    units = {"k": 1024, "m": 1024 ** 2}
+    if text[-1].lower() in units:
+        return float(text[:-1]) * units[text[-1].lower()]
+    return float(text)
+
+
+def parse_schedule(text):
+    # "10:loss=0.1,latency=200; 20:stall=3; 30:drop" -> [(10.0, [действия]), ...]
+    steps = []
+    for item in filter(None, (part.strip() for part in text.split(";"))):
+        at, _, actions = item.partition(":")
+        steps.append((float(at), [a.strip() for a in actions.split(",") if a.strip()]))
+    return sorted(steps)
+
+
+def apply_action(proxy, action):
+    # Одно действие расписания
+    if action == "drop":
+        proxy.drop_connections()
+        return
+    name, _, value = action.partition("=")
+    if name == "stall":
+        proxy.stall(float(value))
+    elif name in ("latency", "jitter"):
+        # Как и в --latency/--jitter, задержки в расписании задаются в мс
+        proxy.set(**{name: float(value) / 1000})
+    elif name == "bandwidth":
+        proxy.set(bandwidth=parse_rate(value) if value != "none" else None)
+    elif name == "fragment":
+        low, _, high = value.partition("-")
+        proxy.set(fragment=(int(low), int(high or low)) if value != "none" else None)
+    else:
+        proxy.set(**{name: float(value)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный прокси с искажением сети для проверки игры")
+    parser.add_argument("upstream", help="адрес сервера игры, например 127.0.0.1:5555")
+    parser.add_argument("--listen", default="127.0.0.1:6000", help="адрес, к которому подключается клиент")
+    parser.add_argument("--udp", action="store_true", help="проксировать UDP вместо TCP")
+    parser.add_argument("--latency", type=float, default=0.0, help="односторонняя задержка, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки, ± мс")
+    parser.add_argument("--bandwidth", help="полоса в каждую сторону: 64k, 1m или байт/с")
+    parser.add_argument("--loss", type=float, default=0.0, help="доля потерь (0..1)")
+    parser.add_argument("--reorder", type=float, default=0.0, help="доля переставленных датаграмм (UDP)")
+    parser.add_argument("--fragment", help="размер записей TCP в байтах: 1-16")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--schedule", help='изменения по времени, с: "10:loss=0.1,latency=200; 20:stall=3; 30:drop" '
+                             '(latency/jitter в мс, stall в с, bandwidth как --bandwidth)')
+    parser.add_argument("--stats", type=float, default=5.0, help="период вывода счетчиков, с")
+    args = parser.parse_args()
+
+    fragment = None
+    if args.fragment:
+        low, _, high = args.fragment.partition("-")
+        fragment = (int(low), int(high or low))
+    proxy = NetworkProxy(parse_address(args.upstream), parse_address(args.listen),
+                         "udp" if args.udp else "tcp",
+                         latency=args.latency / 1000, jitter=args.jitter / 1000,
+                         bandwidth=parse_rate(args.bandwidth) if args.bandwidth else None,
+                         loss=args.loss, reorder=args.reorder, fragment=fragment, seed=args.seed)
+    proxy.start()
+    print(f"Прокси {args.listen} -> {args.upstream} ({'UDP' if args.udp else 'TCP'})", file=sys.stderr)
+
+    schedule = parse_schedule(args.schedule) if args.schedule else []
+    started = time.perf_counter()
+    last_stats = started
+    try:
+        while True:
+            time.sleep(0.05)
+            now = time.perf_counter()
+            while schedule and now - started >= schedule[0][0]:
+                at, actions = schedule.pop(0)
+                for action in actions:
+                    apply_action(proxy, action)
+                print(f"{at:.0f} с: {', '.join(actions)}", file=sys.stderr)
+            if args.stats and now - last_stats >= args.stats:
+                last_stats = now
+                print(proxy.stats.snapshot(), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
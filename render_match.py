@@ -0,0 +1,122 @@
+import os
+
+# Рендеринг без окна и звука: переменные нужно задать до импорта pygame
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import pygame
+
+import snake
+
+# Фоны, уже подготовленные в текущем процессе
+backgrounds = {}
+
+
+def load_states(path):
+    # Чтение заголовка и игровых состояний из записи матча
+    header = None
+    states = []
+    for message in snake.read_recording(path):
+        if not isinstance(message, dict):
+            continue
+        if "recording" in message:
+            header = message
+        elif "snake1" in message:
+            states.append(message)
+    return header, states
+
+
+def get_background(size):
+    # Фон игрового поля под размер записанного экрана
+    if size not in backgrounds:
+        backgrounds[size] = snake.load_image("background.png", (size[0], size[1] - snake.GAME_AREA_TOP))
+    return backgrounds[size]
+
+
+def render_batch(task):
+    # Отрисовка пачки кадров; PNG пишутся сразу, сырые кадры возвращаются
+    start, states, size, board, out_size, fmt, out_dir = task
+    surface = pygame.Surface(size)
+    background = get_background(size)
+    # Поле больше кадра: камера следует за первым игроком
+    camera = snake.Camera(*size) if board != size else None
+    raw = []
+    for i, state in enumerate(states, start):
+        if camera and state.get("snake1"):
+            camera.follow(state["snake1"][-1], board)
+        snake.draw_state(state, surface, background, camera, board)
+        frame = surface if out_size == size else pygame.transform.smoothscale(surface, out_size)
+        if fmt == "png":
+            pygame.image.save(frame, str(Path(out_dir) / f"frame_{i:06d}.png"))
+        else:
+            raw.append(pygame.image.tobytes(frame, "RGB"))
+    return b"".join(raw)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Рендеринг записанного матча в кадры без окна")
+    parser.add_argument("recording", help="файл записи (SNAKE_RECORD=1)")
+    parser.add_argument("output", help="папка для PNG или файл сырого видео ('-' для stdout)")
+    parser.add_argument("--format", choices=["png", "raw"], default="png")
+    parser.add_argument("--scale", type=float, default=1.0, help="масштаб выходных кадров")
+    parser.add_argument("--batch", type=int, default=64, help="кадров в одной пачке")
+    parser.add_argument("--workers", type=int, default=1, help="число рабочих процессов")
+    args = parser.parse_args()
+
+    header, states = load_states(args.recording)
+    if not states:
+        print("В записи нет игровых состояний", file=sys.stderr)
+        return 1
+
+    size = tuple(header["screen"]) if header else (snake.SCREEN_WIDTH, snake.SCREEN_HEIGHT)
+    board = tuple(header.get("board", size)) if header else size
+    fps = header["fps"] if header else snake.FPS
+    out_size = (max(1, int(size[0] * args.scale)), max(1, int(size[1] * args.scale)))
+
+    if args.format == "png":
+        Path(args.output).mkdir(parents=True, exist_ok=True)
+        out = None
+    elif args.output == "-":
+        out = sys.stdout.buffer
+    else:
+        out = open(args.output, "wb")
+
+    tasks = [(i, states[i:i + args.batch], size, board, out_size, args.format, args.output)
+             for i in range(0, len(states), args.batch)]
+
+    started = time.perf_counter()
+    if args.workers > 1:
+        # Пул закрывается через close/join: SDL перехватывает SIGTERM от terminate()
+        pool = Pool(args.workers)
+        for chunk in pool.imap(render_batch, tasks):
+            if out:
+                out.write(chunk)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            chunk = render_batch(task)
+            if out:
+                out.write(chunk)
+    elapsed = time.perf_counter() - started
+
+    if out and out is not sys.stdout.buffer:
+        out.close()
+
+    print(f"Кадров: {len(states)}, {out_size[0]}x{out_size[1]}, {fps} к/с; "
+          f"время {elapsed:.2f} с, быстрее реального в {len(states) / fps / max(elapsed, 1e-9):.0f} раз",
+          file=sys.stderr)
+    if args.format == "raw":
+        print(f"ffmpeg -f rawvideo -pix_fmt rgb24 -s {out_size[0]}x{out_size[1]} -r {fps} -i <файл> match.mp4",
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
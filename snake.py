@@ -1,25 +1,103 @@
 import pygame
+import cProfile
+import io
+import os
+import pstats
 import random
+import secrets
 import sys
 import socket
 import pickle
+import select
+import struct
 import threading
+import time
+import tracemalloc
+from collections import deque
 from pathlib import Path
 
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
 # Инициализация pygame
 pygame.init()
 pygame.mixer.init()
 
+
+def parse_size(value, name):
+    # Разбор размера вида "60x40" из переменной окружения; None — взять значение по умолчанию
+    try:
+        width, height = (int(n) for n in value.lower().split("x"))
+        if width > 0 and height > 0:
+            return width, height
+    except ValueError:
+        pass
+    print(f"Неверное значение {name}: {value}")
+    return None
+
+
 # Константы игры
 SNAKE_BLOCK = 32
 SCORE_PANEL_HEIGHT = 80
-info = pygame.display.Info()
-SCREEN_WIDTH = (info.current_w // SNAKE_BLOCK) * SNAKE_BLOCK
-SCREEN_HEIGHT = (info.current_h // SNAKE_BLOCK) * SNAKE_BLOCK
+# Логическое разрешение (SNAKE_RESOLUTION=1280x720): игра рисуется на холсте
+# этого размера, а на экран его растягивает pygame.SCALED. Объем отрисовки
+# и раскладка поля не зависят от монитора; по умолчанию — родное разрешение
+resolution = os.environ.get("SNAKE_RESOLUTION")
+resolution = resolution and parse_size(resolution, "SNAKE_RESOLUTION")
+if resolution:
+    logical_w, logical_h = resolution
+    DISPLAY_FLAGS = pygame.FULLSCREEN | pygame.SCALED
+else:
+    info = pygame.display.Info()
+    logical_w, logical_h = info.current_w, info.current_h
+    DISPLAY_FLAGS = pygame.FULLSCREEN
+SCREEN_WIDTH = (logical_w // SNAKE_BLOCK) * SNAKE_BLOCK
+SCREEN_HEIGHT = (logical_h // SNAKE_BLOCK) * SNAKE_BLOCK
 GAME_AREA_TOP = SCORE_PANEL_HEIGHT
 GAME_AREA_HEIGHT = SCREEN_HEIGHT - GAME_AREA_TOP
 FPS = 10
 
+# Размер поля в клетках не зависит от экрана (SNAKE_BOARD=2000x2000);
+# по умолчанию поле совпадает с экраном. Границы поля хранятся в пикселях,
+# как и SCREEN_WIDTH/SCREEN_HEIGHT
+board_cells = os.environ.get("SNAKE_BOARD")
+board_cells = board_cells and parse_size(board_cells, "SNAKE_BOARD")
+if board_cells:
+    board_cols, board_rows = board_cells
+    BOARD_WIDTH = board_cols * SNAKE_BLOCK
+    BOARD_HEIGHT = GAME_AREA_TOP + board_rows * SNAKE_BLOCK
+else:
+    BOARD_WIDTH = SCREEN_WIDTH
+    BOARD_HEIGHT = SCREEN_HEIGHT
+INPUT_QUEUE_LIMIT = 3
+
+# Направления движения по клавишам
+KEY_DIRECTIONS = {
+    pygame.K_UP: [0, -SNAKE_BLOCK],
+    pygame.K_DOWN: [0, SNAKE_BLOCK],
+    pygame.K_LEFT: [-SNAKE_BLOCK, 0],
+    pygame.K_RIGHT: [SNAKE_BLOCK, 0],
+}
+
+# Параметры сетевого протокола
+MESSAGE_HEADER = struct.Struct("!I")
+PING_INTERVAL = 1.0
+PING_TIMEOUT = 3.0
+JOIN_TIMEOUT = 2.0
+CONNECTION_TIMEOUT = 3.0
+RECONNECT_GRACE = 15.0
+RECONNECT_INTERVAL = 0.25
+LISTEN_BACKLOG = 16
+SPECTATOR_MAX_SKIP = FPS * 5
+
+# Откатный неткод (SNAKE_ROLLBACK=1 на сервере): оба игрока считают матч сами,
+# а снимков в кольцевом буфере хватает на секунду задержки
+ROLLBACK = os.environ.get("SNAKE_ROLLBACK") == "1"
+ROLLBACK_WINDOW = FPS
+
 # Цвета
 WHITE = (255, 255, 255)
 YELLOW = (255, 255, 102)
@@ -32,7 +110,7 @@ GRAY = (100, 100, 100)
 DARK_GREEN = (14, 63, 14)
 
 # Инициализация экрана
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.FULLSCREEN)
+screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), DISPLAY_FLAGS)
 pygame.display.set_caption("Snake II")
 
 # Шрифты
@@ -46,6 +124,16 @@ clock = pygame.time.Clock()
 RESOURCES_DIR = Path(__file__).parent
 IMAGES_DIR = RESOURCES_DIR / "images"
 SOUNDS_DIR = RESOURCES_DIR / "sounds"
+RECORDINGS_DIR = RESOURCES_DIR / "recordings"
+
+# Запись матчей для последующего рендеринга (SNAKE_RECORD=1)
+RECORD_MATCHES = os.environ.get("SNAKE_RECORD") == "1"
+
+# Профилирование: SNAKE_PROFILE=10 — первые 10 секунд, SNAKE_PROFILE=300t — первые
+# 300 кадров; F9 в любой сцене запускает замер на PROFILE_SECONDS секунд
+PROFILE_SPEC = os.environ.get("SNAKE_PROFILE")
+PROFILE_SECONDS = 10
+PROFILES_DIR = RESOURCES_DIR / "profiles"
 
 # Создание папок для ресурсов
 IMAGES_DIR.mkdir(exist_ok=True)
@@ -98,52 +186,163 @@ game_over_sound = load_sound("game_over.wav")
 background_music = load_sound("background_music.mp3")
 
 
-def draw_snake(snake_list, player=1):
-    # Отрисовка змейки на экране
-    for i, pos in enumerate(snake_list):
-        if player == 1:
-            image = head_img if i == len(snake_list) - 1 else body_img
-        else:
-            image = head2_img if i == len(snake_list) - 1 else body2_img
-        screen.blit(image, (pos[0], pos[1]))
-
-
-def your_score(score1, score2):
+class Camera:
+    # Видимая часть поля, следующая за головой змейки
+    def __init__(self, width=None, height=None):
+        self.width = width or SCREEN_WIDTH
+        self.height = height or SCREEN_HEIGHT
+        self.x = 0
+        self.y = 0
+
+    def follow(self, pos, board):
+        # Центрирование на клетке с упором в края поля
+        board_width, board_height = board
+        center_y = (GAME_AREA_TOP + self.height) // 2
+        self.x = min(max(pos[0] - self.width // 2, 0), max(board_width - self.width, 0))
+        self.y = min(max(pos[1] - center_y, 0), max(board_height - self.height, 0))
+
+    def to_screen(self, pos):
+        # Перевод координат поля в координаты экрана
+        return pos[0] - self.x, pos[1] - self.y
+
+    def steps_to_view(self, pos):
+        # Минимальное число ходов от клетки до видимой области (0 — клетка видна)
+        left, right = self.x - SNAKE_BLOCK, self.x + self.width
+        top, bottom = self.y + GAME_AREA_TOP - SNAKE_BLOCK, self.y + self.height
+        x, y = pos
+        steps = 0
+        if x <= left:
+            steps += (left - x) // SNAKE_BLOCK + 1
+        elif x >= right:
+            steps += (x - right) // SNAKE_BLOCK + 1
+        if y <= top:
+            steps += (top - y) // SNAKE_BLOCK + 1
+        elif y >= bottom:
+            steps += (y - bottom) // SNAKE_BLOCK + 1
+        return steps
+
+
+def draw_snake(snake_list, player=1, surface=None, camera=None):
+    # Отрисовка змейки на экране; с камерой рисуются только видимые сегменты
+    if surface is None:
+        surface = screen
+    if player == 1:
+        head, body = head_img, body_img
+    else:
+        head, body = head2_img, body2_img
+    last = len(snake_list) - 1
+
+    if camera is None:
+        for i, pos in enumerate(snake_list):
+            surface.blit(head if i == last else body, (pos[0], pos[1]))
+        return
+
+    # Соседние сегменты отстоят ровно на одну клетку, поэтому сегмент в k ходах
+    # от видимой области позволяет пропустить следующие k - 1 сегментов
+    i = 0
+    while i <= last:
+        pos = snake_list[i]
+        steps = camera.steps_to_view(pos)
+        if steps:
+            i += steps
+            continue
+        surface.blit(head if i == last else body, camera.to_screen(pos))
+        i += 1
+
+
+def draw_board_border(camera, board, surface=None):
+    # Рамка поля, если оно не совпадает с экраном
+    if surface is None:
+        surface = screen
+    if list(board) == [surface.get_width(), surface.get_height()]:
+        return
+    x, y = camera.to_screen((0, GAME_AREA_TOP))
+    pygame.draw.rect(surface, GRAY, (x, y, board[0], board[1] - GAME_AREA_TOP), 2)
+
+
+def your_score(score1, score2, surface=None):
     # Отображение счета игроков
-    pygame.draw.rect(screen, BLUE, (0, 0, SCREEN_WIDTH, SCORE_PANEL_HEIGHT))
+    if surface is None:
+        surface = screen
+    width = surface.get_width()
+    pygame.draw.rect(surface, BLUE, (0, 0, width, SCORE_PANEL_HEIGHT))
     val1 = font_score.render(f"{player1_name}: {score1}", True, YELLOW)
     val2 = font_score.render(f"{player2_name}: {score2}", True, PURPLE)
-    screen.blit(val1, (10, 10))
-    screen.blit(val2, (SCREEN_WIDTH - 260, 10))
-
-
-def new_food_position(snake1, snake2):
+    surface.blit(val1, (10, 10))
+    surface.blit(val2, (width - 260, 10))
+
+
+def draw_state(state, surface=None, background=None, camera=None, board=None):
+    # Отрисовка состояния игры, полученного по сети или из записи
+    if surface is None:
+        surface = screen
+    surface.fill(BLACK)
+    surface.blit(background or background_img, (0, GAME_AREA_TOP))
+    your_score(state.get("score1", 0), state.get("score2", 0), surface)
+    food = state.get("food", [0, 0])
+    if camera is None:
+        draw_snake(state.get("snake1", []), 1, surface)
+        draw_snake(state.get("snake2", []), 2, surface)
+        surface.blit(food_img, food)
+        return
+    # Камера сдвигается не на целые клетки, и ряд на краю панели виден наполовину:
+    # поле рисуется только под панелью, чтобы не закрывать счет и метрики
+    surface.set_clip((0, GAME_AREA_TOP, surface.get_width(), surface.get_height() - GAME_AREA_TOP))
+    draw_board_border(camera, board, surface)
+    draw_snake(state.get("snake1", []), 1, surface, camera)
+    draw_snake(state.get("snake2", []), 2, surface, camera)
+    if not camera.steps_to_view(food):
+        surface.blit(food_img, camera.to_screen(food))
+    surface.set_clip(None)
+
+
+def draw_net_stats(stats, rollback=None):
+    # Отображение сетевых метрик в панели счета
+    values = stats.snapshot()
+    rtt = f"{values['srtt_ms']:.0f}" if values["srtt_ms"] is not None else "--"
+    text = (f"RTT {rtt} мс  джиттер {values['jitter_ms']:.1f} мс  потери {values['loss']:.0%}  "
+            f"↓{values['throughput_in'] / 1024:.1f} ↑{values['throughput_out'] / 1024:.1f} КБ/с  "
+            f"очередь {values['send_queue']} Б")
+    if rollback:
+        cost = rollback.get_stats()
+        text += (f"  откаты {cost['rollbacks']} (до {cost['max_depth']} тиков, "
+                 f"{cost['resim_ms_max']:.1f} мс)")
+    val = font_leader.render(text, True, WHITE)
+    screen.blit(val, val.get_rect(center=(SCREEN_WIDTH // 2, SCORE_PANEL_HEIGHT - 20)))
+
+
+def new_food_position(snake1, snake2, rng=random, board=None):
     # Генерация новой позиции для еды
     while True:
-        x = random.randint(0, (SCREEN_WIDTH - SNAKE_BLOCK) // SNAKE_BLOCK) * SNAKE_BLOCK
-        y = random.randint(GAME_AREA_TOP // SNAKE_BLOCK, (SCREEN_HEIGHT - SNAKE_BLOCK) // SNAKE_BLOCK) * SNAKE_BLOCK
-        if [x, y] not in snake1 and [x, y] not in snake2:
-            return [x, y]
+        position = generate_random_position(rng, board)
+        if position not in snake1 and position not in snake2:
+            return position
 
 
-def generate_random_position():
-    # Генерация случайной позиции на поле
-    x = random.randint(0, (SCREEN_WIDTH - SNAKE_BLOCK) // SNAKE_BLOCK) * SNAKE_BLOCK
-    y = random.randint(GAME_AREA_TOP // SNAKE_BLOCK, (SCREEN_HEIGHT - SNAKE_BLOCK) // SNAKE_BLOCK) * SNAKE_BLOCK
+def generate_random_position(rng=random, board=None):
+    # Генерация случайной позиции на поле (по умолчанию — на своем поле)
+    width, height = board or (BOARD_WIDTH, BOARD_HEIGHT)
+    x = rng.randint(0, (width - SNAKE_BLOCK) // SNAKE_BLOCK) * SNAKE_BLOCK
+    y = rng.randint(GAME_AREA_TOP // SNAKE_BLOCK, (height - SNAKE_BLOCK) // SNAKE_BLOCK) * SNAKE_BLOCK
     return [x, y]
 
 
-def show_countdown(seconds):
-    # Отображение обратного отсчета перед началом игры
-    font = pygame.font.SysFont("comicsansms", 72)
-    for i in range(seconds, 0, -1):
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
-        text = font.render(str(i), True, YELLOW)
-        text_rect = text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-        screen.blit(text, text_rect)
-        pygame.display.update()
-        pygame.time.delay(1000)
+def queue_input(inputs, direction, current):
+    # Добавление поворота в очередь игрока без разворотов и повторов
+    last = inputs[-1] if inputs else current
+    if direction == last or direction == [-last[0], -last[1]]:
+        return
+    if len(inputs) < INPUT_QUEUE_LIMIT:
+        inputs.append(list(direction))
+
+
+def next_direction(current, inputs):
+    # Один поворот из очереди на текущий тик
+    while inputs:
+        direction = inputs.popleft()
+        if direction != current and direction != [-current[0], -current[1]]:
+            return direction
+    return current
 
 
 class Button:
@@ -206,98 +405,371 @@ def clear_highscores():
         print(f"Ошибка при очистке таблицы лидеров: {e}")
 
 
-class Server:
-    # Класс сервера для сетевой игры
-    def __init__(self, ip, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
-        try:
-            if ip and ip != "localhost":
-                socket.inet_aton(ip)
-            self.sock.bind((ip, port))
-        except socket.error as e:
-            error_msg = f"Ошибка создания сервера: {e}"
-            if "Cannot assign requested address" in str(e):
-                error_msg = "Неверный IP-адрес для сервера"
-            elif "Address already in use" in str(e):
-                error_msg = "Порт уже занят"
-            self.show_error_screen(error_msg)
-            return
-        except OverflowError:
-            self.show_error_screen("Номер порта должен быть от 1 до 65535")
-            return
-        
-        self.sock.listen(1)
-        self.conn = None
-        self.running = True
-        self.receive_thread = None
-        self.restart_requested = False
-        
-        self.wait_for_connection(ip, port)
+def encode_message(message):
+    # Упаковка сообщения в кадр: длина + pickle
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return MESSAGE_HEADER.pack(len(data)) + data
 
-    def wait_for_connection(self, ip, port):
-        # Ожидание подключения клиента
-        cancel_btn = Button("Отмена", SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT - 100, 200, 50, YELLOW, self.cancel_connection)
-        
-        while self.running and not self.conn:
-            screen.fill(BLACK)
-            screen.blit(background_img, (0, GAME_AREA_TOP))
 
-            title = font_score.render("Ожидание подключения...", True, WHITE)
-            ip_text = font_score.render(f"IP: {ip}", True, WHITE)
-            port_text = font_score.render(f"Порт: {port}", True, WHITE)
+def close_socket(sock):
+    # Закрытие сокета с shutdown: close() не будит поток, ждущий в recv() на том же
+    # сокете, и ничего не отправляет, а shutdown завершает прием и шлет FIN
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
 
-            screen.blit(title, title.get_rect(center=(SCREEN_WIDTH // 2, 200)))
-            screen.blit(ip_text, ip_text.get_rect(center=(SCREEN_WIDTH // 2, 250)))
-            screen.blit(port_text, port_text.get_rect(center=(SCREEN_WIDTH // 2, 300)))
-            
-            cancel_btn.draw(screen)
-            pygame.display.update()
 
+def socket_send_queue(sock):
+    # Количество неотправленных байт в очереди сокета (только Linux)
+    if fcntl is None:
+        return 0
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0")
+        return struct.unpack("i", buf)[0]
+    except (OSError, ValueError):
+        return 0
+
+
+class ConnectionStats:
+    # Счетчики и сетевые метрики одного соединения
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.pings_lost = 0
+        self.rtt = None
+        self.srtt = None
+        self.rttvar = 0.0
+        self.jitter = 0.0
+        self.throughput_in = 0.0
+        self.throughput_out = 0.0
+        self.send_queue = 0
+        self.recv_pending = 0
+        self.rate_time = time.perf_counter()
+        self.rate_bytes_in = 0
+        self.rate_bytes_out = 0
+
+    def add_rtt_sample(self, rtt):
+        # Сглаживание RTT (RFC 6298) и расчет джиттера (RFC 3550)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        if self.rtt is not None:
+            self.jitter += (abs(rtt - self.rtt) - self.jitter) / 16
+        self.rtt = rtt
+        self.pongs_received += 1
+
+    def update_throughput(self):
+        # Пересчет пропускной способности раз в секунду
+        now = time.perf_counter()
+        elapsed = now - self.rate_time
+        if elapsed >= 1.0:
+            self.throughput_in = (self.bytes_in - self.rate_bytes_in) / elapsed
+            self.throughput_out = (self.bytes_out - self.rate_bytes_out) / elapsed
+            self.rate_time = now
+            self.rate_bytes_in = self.bytes_in
+            self.rate_bytes_out = self.bytes_out
+
+    @property
+    def loss(self):
+        # Доля пингов, оставшихся без ответа
+        if not self.pings_sent:
+            return 0.0
+        return self.pings_lost / self.pings_sent
+
+    def snapshot(self):
+        # Текущие метрики в виде словаря (RTT и джиттер в миллисекундах)
+        return {
+            "rtt_ms": self.rtt * 1000 if self.rtt is not None else None,
+            "srtt_ms": self.srtt * 1000 if self.srtt is not None else None,
+            "rttvar_ms": self.rttvar * 1000,
+            "jitter_ms": self.jitter * 1000,
+            "loss": self.loss,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "throughput_in": self.throughput_in,
+            "throughput_out": self.throughput_out,
+            "send_queue": self.send_queue,
+            "recv_pending": self.recv_pending,
+        }
+
+
+class Connection:
+    # Соединение с кадрированием сообщений, пингами и телеметрией
+    def __init__(self, sock):
+        self.sock = sock
+        self.stats = ConnectionStats()
+        self.buffer = bytearray()
+        self.send_lock = threading.Lock()
+        self.ping_seq = 0
+        self.pending_pings = {}
+        self.last_ping = 0.0
+        self.last_receive = time.perf_counter()
+        self.closed = False
+
+    def send(self, message):
+        # Отправка одного сообщения
+        self.send_frame(encode_message(message))
+
+    def send_frame(self, frame):
+        # Отправка заранее упакованного кадра
+        with self.send_lock:
+            self.sock.sendall(frame)
+        self.stats.bytes_out += len(frame)
+        self.stats.messages_out += 1
+
+    def receive(self, bufsize=4096):
+        # Чтение из сокета; возвращает полные игровые сообщения или None при разрыве
+        data = self.sock.recv(bufsize)
+        if not data:
+            self.closed = True
+            return None
+        self.last_receive = time.perf_counter()
+        self.stats.bytes_in += len(data)
+        self.buffer += data
+
+        messages = []
+        while len(self.buffer) >= MESSAGE_HEADER.size:
+            (length,) = MESSAGE_HEADER.unpack_from(self.buffer)
+            end = MESSAGE_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            message = pickle.loads(bytes(self.buffer[MESSAGE_HEADER.size:end]))
+            del self.buffer[:end]
+            self.stats.messages_in += 1
+            if not self.handle_control(message):
+                messages.append(message)
+        self.stats.recv_pending = len(self.buffer)
+        return messages
+
+    def handle_control(self, message):
+        # Обработка служебных сообщений ping/pong
+        if not isinstance(message, dict):
+            return False
+        if "ping" in message:
+            self.send({"pong": message["ping"], "time": message["time"]})
+            return True
+        if "pong" in message:
+            if self.pending_pings.pop(message["pong"], None) is not None:
+                self.stats.add_rtt_sample(time.perf_counter() - message["time"])
+            return True
+        return False
+
+    def maybe_ping(self):
+        # Периодическая отправка пинга и учет потерянных ответов
+        now = time.perf_counter()
+        for seq, sent in list(self.pending_pings.items()):
+            if now - sent > PING_TIMEOUT and self.pending_pings.pop(seq, None) is not None:
+                self.stats.pings_lost += 1
+        self.stats.update_throughput()
+        self.stats.send_queue = socket_send_queue(self.sock)
+        if now - self.last_ping < PING_INTERVAL:
+            return
+        self.ping_seq += 1
+        self.pending_pings[self.ping_seq] = now
+        self.last_ping = now
+        self.stats.pings_sent += 1
+        self.send({"ping": self.ping_seq, "time": now})
+
+
+class MatchRecorder:
+    # Запись кадров матча в файл в том же формате, что и по сети
+    def __init__(self, path=None):
+        if path is None:
+            RECORDINGS_DIR.mkdir(exist_ok=True)
+            path = RECORDINGS_DIR / time.strftime("match_%Y%m%d_%H%M%S.rec")
+        self.path = path
+        self.file = open(path, "wb")
+        self.write_frame(encode_message({"recording": 1, "screen": [SCREEN_WIDTH, SCREEN_HEIGHT],
+                                         "board": [BOARD_WIDTH, BOARD_HEIGHT], "fps": FPS}))
+
+    def write_frame(self, frame):
+        # Запись готового кадра
+        self.file.write(frame)
+
+    def close(self):
+        # Закрытие файла записи
+        self.file.close()
+
+
+def read_recording(path):
+    # Последовательное чтение сообщений из записи матча
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(MESSAGE_HEADER.size)
+            if len(header) < MESSAGE_HEADER.size:
+                return
+            (length,) = MESSAGE_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield pickle.loads(data)
+
+
+class SpectatorConnection:
+    # Неблокирующее соединение наблюдателя; кадры не копируются.
+    # От наблюдателя приходят только пинги, ответы уходят между кадрами
+    def __init__(self, sock, buffered=b""):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.stats = ConnectionStats()
+        self.pending = None
+        self.pongs = deque()
+        # Начало следующего сообщения, прочитанное вместе с join
+        self.buffer = bytearray(buffered)
+        self.skipped = 0
+        self.frames_skipped = 0
+
+    def flush(self):
+        # Дописывание начатого кадра и ответов на пинги; True, если все отправлено
+        while True:
+            if self.pending is None:
+                if not self.pongs:
+                    return True
+                self.pending = memoryview(self.pongs.popleft())
             try:
-                self.sock.settimeout(0.1)
-                self.conn, addr = self.sock.accept()
-                self.receive_thread = threading.Thread(target=self.receive_data, daemon=True)
-                self.receive_thread.start()
-                self.reset_game()
-                clear_highscores()
-                self.run()
-            except socket.timeout:
-                pass
-            except Exception as e:
-                print(f"Ошибка подключения: {e}")
-                self.running = False
+                sent = self.sock.send(self.pending)
+            except BlockingIOError:
+                return False
+            self.stats.bytes_out += sent
+            self.pending = self.pending[sent:]
+            if not self.pending:
+                self.pending = None
+                self.stats.messages_out += 1
+
+    def drain(self):
+        # Чтение пришедших пингов без блокировки и ответ на них; False при разрыве
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except BlockingIOError:
+                break
+            if not data:
+                return False
+            self.stats.bytes_in += len(data)
+            self.buffer += data
+        while len(self.buffer) >= MESSAGE_HEADER.size:
+            (length,) = MESSAGE_HEADER.unpack_from(self.buffer)
+            end = MESSAGE_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            message = pickle.loads(bytes(self.buffer[MESSAGE_HEADER.size:end]))
+            del self.buffer[:end]
+            self.stats.messages_in += 1
+            if isinstance(message, dict) and "ping" in message:
+                self.pongs.append(encode_message({"pong": message["ping"], "time": message["time"]}))
+        self.flush()
+        return True
+
+    def push(self, frame):
+        # Постановка кадра в отправку; медленный наблюдатель пропускает кадры
+        if not self.flush():
+            self.skipped += 1
+            self.frames_skipped += 1
+            return self.skipped <= SPECTATOR_MAX_SKIP
+        self.skipped = 0
+        self.pending = frame
+        self.flush()
+        return True
+
+    def close(self):
+        # Закрытие соединения наблюдателя
+        try:
+            self.sock.close()
+        except OSError:
+            pass
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    if cancel_btn.is_clicked(event.pos):
-                        self.cancel_connection()
-                        return
 
-            clock.tick(30)
+class SpectatorHub:
+    # Рассылка состояния наблюдателям: кадр кодируется один раз на тик.
+    # Фоновый поток отвечает на пинги наблюдателей в любой сцене сервера
+    def __init__(self):
+        self.spectators = []
+        self.lock = threading.Lock()
+        self.running = False
 
-    def receive_data(self):
-        # Получение данных от клиента
-        while self.running and self.conn:
+    def add(self, sock, greeting=None, buffered=b""):
+        # Добавление нового наблюдателя с начальным кадром
+        spectator = SpectatorConnection(sock, buffered)
+        with self.lock:
+            self.spectators.append(spectator)
+            if greeting:
+                spectator.push(memoryview(greeting))
+        if not self.running:
+            self.running = True
+            threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        # Ожидание данных от наблюдателей: пинги и разрывы соединения
+        while self.running:
+            with self.lock:
+                sockets = {spectator.sock: spectator for spectator in self.spectators}
+            if not sockets:
+                time.sleep(0.05)
+                continue
             try:
-                data = self.conn.recv(1024)
-                if not data:
-                    break
-                    
-                message = pickle.loads(data)
-                
-                if isinstance(message, dict) and message.get("request_restart"):
-                    self.restart_requested = True
-                elif isinstance(message, list):
-                    self.dir2 = message
-            except (ConnectionError, pickle.UnpicklingError):
-                break
-            except Exception as e:
-                print(f"Ошибка получения данных: {e}")
+                readable = select.select(list(sockets), [], [], 0.05)[0]
+            except (OSError, ValueError):
+                # Сокет закрыли, пока шло ожидание; список уже обновлен
                 continue
+            with self.lock:
+                for sock in readable:
+                    spectator = sockets[sock]
+                    if spectator not in self.spectators:
+                        continue
+                    try:
+                        keep = spectator.drain()
+                    except (OSError, pickle.UnpicklingError):
+                        keep = False
+                    if not keep:
+                        spectator.close()
+                        self.spectators.remove(spectator)
+
+    def broadcast(self, frame):
+        # Запись общего неизменяемого кадра во все сокеты наблюдателей
+        view = memoryview(frame)
+        with self.lock:
+            for spectator in list(self.spectators):
+                try:
+                    keep = spectator.push(view)
+                except OSError:
+                    keep = False
+                if not keep:
+                    spectator.close()
+                    self.spectators.remove(spectator)
+
+    def close(self):
+        # Отключение всех наблюдателей
+        self.running = False
+        with self.lock:
+            for spectator in self.spectators:
+                spectator.close()
+            self.spectators = []
+
+    def __len__(self):
+        return len(self.spectators)
+
+
+class Game:
+    # Правила матча без сети и отрисовки: две змейки, еда, столкновения.
+    # Поле [ширина, высота] в пикселях; у клиента — поле сервера, а не свое
+    def __init__(self, rng=None, board=None):
+        self.rng = rng or random
+        self.board = list(board or (BOARD_WIDTH, BOARD_HEIGHT))
+        self.reset_game()
 
     def move(self, snake, direction):
         # Движение змейки
@@ -308,17 +780,17 @@ class Server:
                 self.score1 += 1
             else:
                 self.score2 += 1
-            if eat_sound:
-                eat_sound.play()
-            self.food = new_food_position(self.snake1, self.snake2)
+            self.on_eat()
+            self.food = new_food_position(self.snake1, self.snake2, self.rng, self.board)
         else:
             snake.pop(0)
 
     def check_collision(self, snake, other_snake=None):
         # Проверка столкновений змейки
         head = snake[-1]
-        if (head[0] < 0 or head[0] >= SCREEN_WIDTH or
-            head[1] < GAME_AREA_TOP or head[1] >= SCREEN_HEIGHT):
+        width, height = self.board
+        if (head[0] < 0 or head[0] >= width or
+            head[1] < GAME_AREA_TOP or head[1] >= height):
             return True
         
         if head in snake[:-1]:
@@ -331,192 +803,532 @@ class Server:
 
     def reset_game(self):
         # Сброс состояния игры
-        self.snake1 = [generate_random_position()]
-        self.snake2 = [generate_random_position()]
+        self.snake1 = [generate_random_position(self.rng, self.board)]
+        self.snake2 = [generate_random_position(self.rng, self.board)]
         self.dir1 = [SNAKE_BLOCK, 0]
         self.dir2 = [-SNAKE_BLOCK, 0]
+        self.inputs1 = deque()
+        self.inputs2 = deque()
         self.score1 = 0
         self.score2 = 0
-        self.food = new_food_position(self.snake1, self.snake2)
+        self.food = new_food_position(self.snake1, self.snake2, self.rng, self.board)
         self.winner = None
         self.game_over = False
+
+    def step(self):
+        # Один игровой тик: повороты из очередей ввода, затем движение
+        self.dir1 = next_direction(self.dir1, self.inputs1)
+        self.dir2 = next_direction(self.dir2, self.inputs2)
+        self.update()
+
+    def update(self):
+        # Движение и столкновения при уже выбранных направлениях
+        self.move(self.snake1, self.dir1)
+        self.move(self.snake2, self.dir2)
+
+        snake1_collision = self.check_collision(self.snake1, self.snake2)
+        snake2_collision = self.check_collision(self.snake2, self.snake1)
+
+        if snake1_collision and snake2_collision:
+            self.game_over = True
+            self.winner = "Ничья"
+        elif snake1_collision:
+            self.game_over = True
+            self.winner = player2_name
+        elif snake2_collision:
+            self.game_over = True
+            self.winner = player1_name
+
+    def game_state(self):
+        # Состояние матча для рассылки, записи и возобновления после переподключения
+        return {
+            "snake1": self.snake1,
+            "snake2": self.snake2,
+            "food": self.food,
+            "score1": self.score1,
+            "score2": self.score2,
+            "winner": self.winner,
+            "game_over": self.game_over,
+            "restart": False
+        }
+
+    def on_eat(self):
+        # Реакция на поедание еды (в чистых правилах ничего не делает)
+        pass
+
+    def snapshot(self):
+        # Компактный снимок состояния: сегменты змеек не меняются на месте,
+        # поэтому достаточно копий списков
+        return (list(self.snake1), list(self.snake2), self.dir1, self.dir2, self.food,
+                self.score1, self.score2, self.winner, self.game_over, self.rng.getstate())
+
+    def restore(self, snapshot):
+        # Возврат к снимку состояния
+        (snake1, snake2, self.dir1, self.dir2, self.food,
+         self.score1, self.score2, self.winner, self.game_over, rng_state) = snapshot
+        self.snake1 = list(snake1)
+        self.snake2 = list(snake2)
+        self.rng.setstate(rng_state)
+
+
+class Rollback:
+    # Откатный неткод: свой ввод применяется сразу, ввод соперника предсказывается
+    # (змейка едет прямо); опоздавший ввод откатывает матч к снимку и тики
+    # пересчитываются заново. Глубина отката не больше окна снимков
+    def __init__(self, game, local, start_tick=0, window=ROLLBACK_WINDOW):
+        self.game = game
+        self.local = local
+        self.remote = 3 - local
+        self.window = window
+        self.tick = start_tick
+        self.remote_tick = start_tick
+        self.snapshots = [None] * window
+        self.inputs = {1: {}, 2: {}}
+        self.incoming = deque()
+        self.over_tick = None
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.max_depth = 0
+        self.desyncs = 0
+        self.stalls = 0
+        self.resim_times = deque(maxlen=FPS * 10)
+        # Идет пересчет уже сыгранных тиков: звуки и прочие эффекты не повторяются
+        self.resimulating = False
+
+    def local_queue(self):
+        # Очередь поворотов своего игрока (в нее пишет обработчик клавиш)
+        return self.game.inputs1 if self.local == 1 else self.game.inputs2
+
+    def simulate(self):
+        # Один тик по известному и предсказанному вводу со снимком перед ним
+        game = self.game
+        self.snapshots[self.tick % self.window] = (game.snapshot(), self.over_tick)
+        game.dir1 = self.inputs[1].get(self.tick, game.dir1)
+        game.dir2 = self.inputs[2].get(self.tick, game.dir2)
+        if not game.game_over:
+            game.update()
+            if game.game_over:
+                self.over_tick = self.tick
+        self.tick += 1
+
+    def rewind(self, tick, snapshot=None):
+        # Откат к тику (или к присланному снимку) и пересчет до текущего тика
+        started = time.perf_counter()
+        target = self.tick
+        state, self.over_tick = snapshot or self.snapshots[tick % self.window]
+        self.game.restore(state)
+        self.tick = tick
+        self.resimulating = True
+        try:
+            while self.tick < target:
+                self.simulate()
+        finally:
+            self.resimulating = False
+        depth = target - tick
+        self.rollbacks += 1
+        self.resimulated += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.resim_times.append(time.perf_counter() - started)
+
+    def apply_incoming(self):
+        # Разбор пришедшего ввода соперника и сверок; откат не глубже окна
+        earliest = None
+        while self.incoming:
+            message = self.incoming.popleft()
+            if isinstance(message, dict):
+                # Сверка идет после ввода, пришедшего раньше нее
+                if earliest is not None:
+                    self.rewind(earliest)
+                    earliest = None
+                self.check_sync(message["sync"], message["snapshot"])
+                continue
+            tick, dx, dy = message
+            self.remote_tick = max(self.remote_tick, tick + 1)
+            if dx == 0 and dy == 0:
+                continue
+            # Слишком старый ввод применяется на самом раннем тике окна;
+            # расхождение потом исправит сверка с сервером
+            tick = max(tick, self.tick - self.window + 1)
+            self.inputs[self.remote][tick] = [dx, dy]
+            if tick < self.tick and (earliest is None or tick < earliest):
+                earliest = tick
+        if earliest is not None:
+            self.rewind(earliest)
+
+    def check_sync(self, tick, snapshot):
+        # Сверка с подтвержденным состоянием сервера; при расхождении оно принимается
+        if tick > self.tick or tick <= self.tick - self.window:
+            return
+        own = self.game.snapshot() if tick == self.tick else self.snapshots[tick % self.window][0]
+        if own != snapshot[0]:
+            self.desyncs += 1
+            self.rewind(tick, snapshot)
+
+    def advance(self):
+        # Тик без ожидания соперника; None, если соперник отстал больше чем на окно.
+        # Возвращает сообщение для соперника: поворот или пустой ввод как отметку тика
+        self.apply_incoming()
+        if self.tick - self.remote_tick >= self.window - 1:
+            self.stalls += 1
+            return None
+        tick = self.tick
+        game = self.game
+        current = game.dir1 if self.local == 1 else game.dir2
+        direction = next_direction(current, self.local_queue())
+        message = (tick, 0, 0)
+        if direction != current:
+            self.inputs[self.local][tick] = direction
+            message = (tick, direction[0], direction[1])
+        self.simulate()
+        if tick % self.window == 0:
+            for inputs in self.inputs.values():
+                for old in [t for t in inputs if t < tick - self.window]:
+                    del inputs[old]
+        return message
+
+    def confirmed_over(self):
+        # Исход матча подтвержден: ввод соперника известен до тика окончания
+        return self.game.game_over and self.over_tick is not None and self.remote_tick > self.over_tick
+
+    def sync_message(self):
+        # Подтвержденное состояние (ввод обоих известен) для сверки у соперника
+        tick = min(self.remote_tick, self.tick)
+        if tick == self.tick:
+            snapshot = (self.game.snapshot(), self.over_tick)
+        elif tick > self.tick - self.window:
+            snapshot = self.snapshots[tick % self.window]
+        else:
+            return None
+        return {"sync": tick, "snapshot": snapshot}
+
+    def get_stats(self):
+        # Стоимость пересчета и число откатов
+        times = sorted(self.resim_times)
+        return {
+            "rollbacks": self.rollbacks,
+            "resimulated": self.resimulated,
+            "max_depth": self.max_depth,
+            "resim_ms_mean": sum(times) / len(times) * 1000 if times else 0.0,
+            "resim_ms_max": times[-1] * 1000 if times else 0.0,
+            "desyncs": self.desyncs,
+            "stalls": self.stalls,
+        }
+
+
+class Server(Game):
+    # Класс сервера для сетевой игры
+    def __init__(self, ip, port):
+        Game.__init__(self)
+        self.ip = ip
+        self.port = port
+        self.conn = None
+        self.connection = None
+        self.spectators = SpectatorHub()
+        self.recorder = None
+        self.show_stats = False
+        self.running = False
+        self.receive_thread = None
         self.restart_requested = False
+        self.last_input_seq = 0
+        self.error_msg = ""
+        self.session_token = None
+        self.lost_at = None
+        self.pending = []
+        self.rollback = None
+        self.board_frame = encode_message({"board": self.board})
 
-    def show_game_over_screen(self, winner=None, score=None):
-        # Отображение экрана окончания игры
-        if background_music and background_music.get_num_channels() > 0:
-            background_music.stop()
-        if game_over_sound:
-            game_over_sound.play()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        elements = []
-        if winner:
-            win_text = font_end.render(f"Победил {winner}!", True, YELLOW)
-            win_rect = win_text.get_rect(center=(SCREEN_WIDTH//2, 150))
-            elements.append((win_text, win_rect))
+        try:
+            if ip and ip != "localhost":
+                socket.inet_aton(ip)
+            self.sock.bind((ip, port))
+        except socket.error as e:
+            self.error_msg = f"Ошибка создания сервера: {e}"
+            if "Cannot assign requested address" in str(e):
+                self.error_msg = "Неверный IP-адрес для сервера"
+            elif "Address already in use" in str(e):
+                self.error_msg = "Порт уже занят"
+            self.safe_close()
+            return
+        except OverflowError:
+            self.error_msg = "Номер порта должен быть от 1 до 65535"
+            self.safe_close()
+            return
 
-            score_text = font_score.render(f"Очки: {score}", True, YELLOW)
-            score_rect = score_text.get_rect(center=(SCREEN_WIDTH//2, 200))
-            elements.append((score_text, score_rect))
+        self.sock.listen(LISTEN_BACKLOG)
+        self.running = True
 
-        highscores = load_highscores()
-        if highscores:
-            top_text = font_score.render("Топ игроков:", True, WHITE)
-            top_rect = top_text.get_rect(center=(SCREEN_WIDTH//2, 250))
-            elements.append((top_text, top_rect))
+    def accept_player(self, clear_scores=True):
+        # Одна короткая попытка принять игрока; наблюдатели добавляются сразу.
+        # Безголовые инструменты не трогают таблицу рекордов (clear_scores=False)
+        try:
+            self.sock.settimeout(0.1)
+            conn, addr = self.sock.accept()
+        except socket.timeout:
+            return False
+        connection = Connection(conn)
+        role = self.read_role(connection)
+        if role == "spectator":
+            self.spectators.add(conn, self.board_frame, connection.buffer)
+            return False
+        if role != "player":
+            # Закрылось или промолчало JOIN_TIMEOUT: ждем дальше
+            conn.close()
+            return False
+        self.session_token = secrets.token_hex(8)
+        self.reset_game()
+        self.attach_player(connection)
+        try:
+            self.connection.send({"session": self.session_token, "rollback_mode": ROLLBACK})
+        except OSError:
+            self.drop_player()
+            return False
+        if clear_scores:
+            clear_highscores()
+        return True
+
+    def attach_player(self, connection):
+        # Назначение соединения игроку и запуск потока приема
+        connection.sock.settimeout(None)
+        self.conn = connection.sock
+        self.connection = connection
+        self.lost_at = None
+        self.connection.send_frame(self.board_frame)
+        self.receive_thread = threading.Thread(target=self.receive_data, args=(connection,), daemon=True)
+        self.receive_thread.start()
+
+    def read_role(self, connection):
+        # Чтение роли подключившегося: игрок или наблюдатель
+        connection.sock.settimeout(JOIN_TIMEOUT)
+        try:
+            while True:
+                messages = connection.receive()
+                if messages is None:
+                    return None
+                # Пустой список — сообщение пришло не целиком, читаем дальше
+                for message in messages:
+                    if isinstance(message, dict) and "join" in message:
+                        return message["join"]
+        except (socket.timeout, OSError, pickle.UnpicklingError):
+            return None
+        finally:
+            connection.sock.settimeout(None)
+
+    def accept_pending(self):
+        # Неблокирующий прием подключений во время матча: наблюдатели
+        # и вернувшийся игрок различаются по сообщению join
+        self.sock.setblocking(False)
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            conn.setblocking(False)
+            self.pending.append((Connection(conn), time.perf_counter()))
 
-            for i, (win, s) in enumerate(highscores[:5]):
-                entry = font_leader.render(f"{i+1}. {win} - {s}", True, WHITE)
-                entry_rect = entry.get_rect(center=(SCREEN_WIDTH//2, 300 + i*30))
-                elements.append((entry, entry_rect))
+        for item in list(self.pending):
+            connection, accepted = item
+            try:
+                messages = connection.receive()
+            except BlockingIOError:
+                messages = []
+            except (OSError, pickle.UnpicklingError):
+                messages = None
+            join = None
+            for message in messages or []:
+                if isinstance(message, dict) and "join" in message:
+                    join = message
+            if join is None and messages is not None and time.perf_counter() - accepted < JOIN_TIMEOUT:
+                continue
 
-        exit_btn = Button("Выход", SCREEN_WIDTH//2 + 20, SCREEN_HEIGHT - 150, 200, 50, RED, self.exit_to_menu)
+            self.pending.remove(item)
+            if join and join["join"] == "spectator":
+                self.spectators.add(connection.sock, self.board_frame, connection.buffer)
+            elif join and self.session_token and join.get("session") == self.session_token:
+                self.resume_player(connection)
+            else:
+                connection.sock.close()
+
+    def resume_player(self, connection):
+        # Возвращение игрока в идущий матч: снимок состояния за один кадр
+        old = self.conn
+        self.attach_player(connection)
+        if old:
+            close_socket(old)
+        try:
+            self.connection.send({"resume": self.game_state(), "session": self.session_token})
+            if self.rollback:
+                # Ввод, потерянный вместе с соединением, уже не придет: отсчет заново
+                self.rollback = Rollback(self, 1, self.rollback.tick)
+                self.send_rollback_start()
+        except OSError:
+            self.drop_player()
+
+    def drop_player(self):
+        # Потеря игрока: матч на паузе до переподключения или истечения RECONNECT_GRACE
+        if self.conn:
+            close_socket(self.conn)
+        self.conn = None
+        self.connection = None
+        self.lost_at = time.perf_counter()
+
+    def check_player(self):
+        # Разрыв или молчание клиента дольше CONNECTION_TIMEOUT
+        connection = self.connection
+        if connection and (connection.closed or
+                           time.perf_counter() - connection.last_receive > CONNECTION_TIMEOUT):
+            self.drop_player()
+
+    def broadcast(self, message):
+        # Кодирование сообщения один раз и отправка игроку и наблюдателям
+        frame = encode_message(message)
+        if self.recorder:
+            self.recorder.write_frame(frame)
+        self.connection.send_frame(frame)
+        self.spectators.broadcast(frame)
+
+    def receive_data(self, connection):
+        # Получение данных от клиента
+        while self.running and self.connection is connection:
+            try:
+                messages = connection.receive()
+                if messages is None:
+                    break
 
-        alpha = 0
-        fade_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-        fade_surface.fill(BLACK)
+                for message in messages:
+                    if isinstance(message, dict) and message.get("request_restart"):
+                        self.restart_requested = True
+                    elif isinstance(message, tuple) and self.rollback:
+                        self.rollback.incoming.append(message)
+                    elif isinstance(message, tuple) and message[0] > self.last_input_seq:
+                        queue_input(self.inputs2, [message[1], message[2]], self.dir2)
+                        self.last_input_seq = message[0]
+            except (ConnectionError, pickle.UnpicklingError):
+                break
+            except Exception as e:
+                print(f"Ошибка получения данных: {e}")
+                continue
 
-        waiting = True
+    def game_state(self):
+        # Состояние для рассылки с подтверждением ввода клиента: номер последнего
+        # полученного поворота, последний принятый поворот и длина очереди
+        state = Game.game_state(self)
+        state["input_seq"] = self.last_input_seq
+        state["turn2"] = list(self.inputs2[-1] if self.inputs2 else self.dir2)
+        state["queued2"] = len(self.inputs2)
+        return state
 
-        while waiting and self.running:
-            try:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        self.running = False
-                        return
-                    elif event.type == pygame.MOUSEBUTTONDOWN:
-                            exit_btn.is_clicked(event.pos)
-                            exit_btn.action()
-                            waiting = False
-
-                if self.restart_requested:
-                    self.restart_game()
-                    waiting = False
-
-                alpha = min(alpha + 5, 255)
-                fade_surface.set_alpha(255 - alpha)
-                screen.fill(BLACK)
-                screen.blit(background_img, (0, GAME_AREA_TOP))
-
-                for element, rect in elements:
-                    element.set_alpha(alpha)
-                    screen.blit(element, rect)
-
-                exit_btn.draw(screen)
-                screen.blit(fade_surface, (0, 0))
-
-                pygame.display.flip()
-                clock.tick(30)
-            except pygame.error:
-                self.running = False
-                return
+    def reset_game(self):
+        # Сброс состояния игры и запроса на рестарт
+        Game.reset_game(self)
+        self.restart_requested = False
+        self.rollback = None
+
+    def tick(self):
+        # Один игровой тик с рассылкой состояния
+        if self.rollback:
+            self.rollback_tick()
+            return
+        self.step()
+        try:
+            self.broadcast(self.game_state())
+            self.connection.maybe_ping()
+        except OSError:
+            self.drop_player()
+
+    def rollback_tick(self):
+        # Тик в режиме отката: игроку уходят только вводы и сверки,
+        # наблюдателям и в запись — текущее (возможно, предсказанное) состояние
+        rollback = self.rollback
+        message = rollback.advance()
+        try:
+            if message:
+                self.connection.send(message)
+                if message[0] % FPS == 0:
+                    sync = rollback.sync_message()
+                    if sync:
+                        self.connection.send(sync)
+            if rollback.confirmed_over():
+                # Итог подтвержден: клиент получает обычное финальное состояние
+                self.broadcast(self.game_state())
+            else:
+                frame = encode_message(self.game_state())
+                if self.recorder:
+                    self.recorder.write_frame(frame)
+                self.spectators.broadcast(frame)
+            self.connection.maybe_ping()
+        except OSError:
+            self.drop_player()
+
+    def match_over(self):
+        # Матч окончен; в режиме отката — когда исход подтвержден вводом клиента
+        if self.rollback:
+            return self.rollback.confirmed_over()
+        return self.game_over
+
+    def send_rollback_start(self):
+        # Начальный снимок (вместе с состоянием генератора еды) и поле для клиента
+        self.connection.send({"rollback": {"tick": self.rollback.tick, "board": self.board,
+                                           "snapshot": (self.snapshot(), None)}})
+
+    def on_eat(self):
+        # Звук поедания слышен только на сервере, при пересчете отката — один раз
+        if eat_sound and not (self.rollback and self.rollback.resimulating):
+            eat_sound.play()
 
     def restart_game(self):
         # Перезапуск игры
         self.reset_game()
         if self.conn:
             try:
-                self.conn.sendall(pickle.dumps({"restart": True}))
-            except ConnectionError:
+                self.broadcast({"restart": True})
+            except OSError:
                 print("Не удалось отправить команду перезапуска клиенту")
-        self.run()
-
-    def exit_to_menu(self):
-        # Выход в главное меню
-        self.safe_close()
-        main_menu()
-
-    def run(self):
-        # Основной игровой цикл сервера
-        if not self.conn:
-            return
-        
-        screen.fill(BLACK)
-        pygame.display.update()
-        
-        show_countdown(3)
-        
-        while self.running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                    break
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_UP and self.dir1 != [0, SNAKE_BLOCK]:
-                        self.dir1 = [0, -SNAKE_BLOCK]
-                    elif event.key == pygame.K_DOWN and self.dir1 != [0, -SNAKE_BLOCK]:
-                        self.dir1 = [0, SNAKE_BLOCK]
-                    elif event.key == pygame.K_LEFT and self.dir1 != [SNAKE_BLOCK, 0]:
-                        self.dir1 = [-SNAKE_BLOCK, 0]
-                    elif event.key == pygame.K_RIGHT and self.dir1 != [-SNAKE_BLOCK, 0]:
-                        self.dir1 = [SNAKE_BLOCK, 0]
-
-            if not self.game_over:
-                self.move(self.snake1, self.dir1)
-                self.move(self.snake2, self.dir2)
-
-                snake1_collision = self.check_collision(self.snake1, self.snake2)
-                snake2_collision = self.check_collision(self.snake2, self.snake1)
-                
-                if snake1_collision and snake2_collision:
-                    self.game_over = True
-                    self.winner = "Ничья"
-                elif snake1_collision:
-                    self.game_over = True
-                    self.winner = player2_name
-                elif snake2_collision:
-                    self.game_over = True
-                    self.winner = player1_name
 
+    def get_stats(self):
+        # Сетевые метрики соединения с клиентом
+        if not self.connection:
+            return {}
+        stats = self.connection.stats.snapshot()
+        stats["spectators"] = len(self.spectators)
+        stats["spectator_frames_skipped"] = sum(s.frames_skipped for s in self.spectators.spectators)
+        if self.rollback:
+            stats.update(self.rollback.get_stats())
+        return stats
+
+    def start_match(self):
+        # Начало матча: запись (если включена) и отсчет тишины клиента заново,
+        # так как во время обратного отсчета клиент ничего не отправляет
+        if RECORD_MATCHES and not self.recorder:
+            self.recorder = MatchRecorder()
+        if self.connection:
+            self.connection.last_receive = time.perf_counter()
+            if ROLLBACK:
+                # Еда должна выпадать одинаково у обоих: отдельный генератор,
+                # состояние которого уходит клиенту в начальном снимке
+                self.rng = random.Random()
+                self.rollback = Rollback(self, 1)
                 try:
-                    state = {
-                        "snake1": self.snake1,
-                        "snake2": self.snake2,
-                        "food": self.food,
-                        "score1": self.score1,
-                        "score2": self.score2,
-                        "winner": self.winner,
-                        "game_over": self.game_over,
-                        "restart": False
-                    }
-                    self.conn.sendall(pickle.dumps(state))
-                except ConnectionError:
-                    self.running = False
-                    break
+                    self.send_rollback_start()
+                except OSError:
+                    self.drop_player()
 
-            screen.fill(BLACK)
-            screen.blit(background_img, (0, GAME_AREA_TOP))
-            your_score(self.score1, self.score2)
-            draw_snake(self.snake1, 1)
-            draw_snake(self.snake2, 2)
-            screen.blit(food_img, self.food)
-            pygame.display.update()
-            clock.tick(FPS)
-
-            if self.game_over:
-                if self.winner != "Ничья?":
-                    save_score(self.winner, max(self.score1, self.score2))
-                self.show_game_over_screen(self.winner, max(self.score1, self.score2))
-                break
-
-    def cancel_connection(self):
-        # Отмена подключения
-        self.running = False
-        if self.conn:
-            try:
-                self.conn.close()
-            except:
-                pass
-        try:
-            self.sock.close()
-        except:
-            pass
-        if self.receive_thread and self.receive_thread.is_alive():
-            self.receive_thread.join(timeout=1)
-        main_menu()
+    def stop_recording(self):
+        # Завершение записи текущего матча
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
 
     def safe_close(self):
         # Безопасное закрытие соединений
+        self.running = False
+        self.stop_recording()
+        self.spectators.close()
+        for connection, accepted in self.pending:
+            connection.sock.close()
+        self.pending = []
         if self.conn:
             try:
                 self.conn.close()
@@ -527,56 +1339,55 @@ class Server:
                 self.sock.close()
             except:
                 pass
-        self.running = False
-
-    def show_error_screen(self, msg):
-        # Отображение экрана с ошибкой
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
-        
-        error_text = font_end.render("Ошибка подключения", True, RED)
-        msg_text = font_score.render(msg, True, WHITE)
-        back_text = font_score.render("Нажмите любую клавишу для возврата в меню", True, YELLOW)
-        
-        screen.blit(error_text, error_text.get_rect(center=(SCREEN_WIDTH//2, 200)))
-        screen.blit(msg_text, msg_text.get_rect(center=(SCREEN_WIDTH//2, 300)))
-        screen.blit(back_text, back_text.get_rect(center=(SCREEN_WIDTH//2, 400)))
-        
-        pygame.display.flip()
-        
-        waiting = True
-        while waiting:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                    waiting = False
-        
-        main_menu()
+        if self.receive_thread and self.receive_thread.is_alive():
+            self.receive_thread.join(timeout=1)
 
 
 class Client:
     # Класс клиента для сетевой игры
+    role = "player"
+
     def __init__(self, ip, port):
         self.ip = ip
         self.port = port
         self.sock = None
         self.running = False
         self.error_msg = ""
+        self.connection = None
+        self.state = {}
+        self.board = [BOARD_WIDTH, BOARD_HEIGHT]
+        self.show_stats = False
+        self.session_token = None
+        self.resumed = False
+        self.rollback = None
+        self.rollback_mode = False
+        # Повороты, нажатые до начального снимка матча в режиме отката
+        self.early_inputs = deque()
         self.connect()
 
+    def open_connection(self, timeout=5):
+        # Открытие сокета и отправка роли (с токеном сессии при переподключении)
+        if self.ip and self.ip != "localhost":
+            socket.inet_aton(self.ip)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect((self.ip, self.port))
+        self.sock.settimeout(None)
+        self.connection = Connection(self.sock)
+        join = {"join": self.role}
+        if self.session_token:
+            join["session"] = self.session_token
+        self.connection.send(join)
+
     def connect(self):
         # Подключение к серверу
         try:
-            if self.ip and self.ip != "localhost":
-                socket.inet_aton(self.ip)
-                
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(5)
-            self.sock.connect((self.ip, self.port))
-            self.sock.settimeout(None)
-            self.direction = [SNAKE_BLOCK, 0]
+            self.open_connection()
+            self.direction = [-SNAKE_BLOCK, 0]
+            self.queued = 0
+            self.pending_inputs = []
+            self.input_seq = 0
             self.running = True
             self.game_over = False
             return True
@@ -590,411 +1401,1000 @@ class Client:
         
         return False
 
-    def run(self):
-        # Основной игровой цикл клиента
-        if not self.running or not self.sock:
-            self.show_error_screen()
-            return
-        
-        show_countdown(3)
-        
-        while self.running:
-            try:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        self.running = False
-                        break
-                    elif event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_UP and self.direction != [0, SNAKE_BLOCK]:
-                            self.direction = [0, -SNAKE_BLOCK]
-                        elif event.key == pygame.K_DOWN and self.direction != [0, -SNAKE_BLOCK]:
-                            self.direction = [0, SNAKE_BLOCK]
-                        elif event.key == pygame.K_LEFT and self.direction != [SNAKE_BLOCK, 0]:
-                            self.direction = [-SNAKE_BLOCK, 0]
-                        elif event.key == pygame.K_RIGHT and self.direction != [-SNAKE_BLOCK, 0]:
-                            self.direction = [SNAKE_BLOCK, 0]
-                    elif event.type == pygame.MOUSEBUTTONDOWN:
-                        pos = pygame.mouse.get_pos()
-
-                if not self.game_over and self.direction:
-                    self.sock.sendall(pickle.dumps(self.direction))
-                
-                data = self.sock.recv(4096)
-                if not data:
-                    self.error_msg = "Соединение с сервером разорвано"
-                    self.running = False
-                    break
-                    
-                received = pickle.loads(data)
-                
-                if isinstance(received, dict):
-                    if received.get("restart", False):
-                        self.game_over = False
-                        continue
-                        
-                    self.state = received
+    def reconnect(self):
+        # Быстрое переподключение к идущему матчу по токену сессии
+        self.safe_close()
+        self.resumed = False
+        # Сервер пришлет новый начальный снимок вслед за resume
+        self.rollback = None
+        try:
+            self.open_connection(RECONNECT_INTERVAL * 2)
+            self.sock.settimeout(JOIN_TIMEOUT)
+            while not self.resumed:
+                if not self.receive_state():
+                    raise ConnectionError("Сервер закрыл соединение")
+            self.sock.settimeout(CONNECTION_TIMEOUT)
+        except (OSError, pickle.UnpicklingError):
+            self.safe_close()
+            return False
+        self.running = True
+        return True
+
+    def receive_state(self):
+        # Получение сообщений сервера; False при разрыве соединения
+        self.connection.maybe_ping()
+        messages = self.connection.receive()
+        if messages is None:
+            return False
+
+        for received in messages:
+            if isinstance(received, tuple):
+                # Ввод игрока сервера в режиме отката
+                if self.rollback:
+                    self.rollback.incoming.append(received)
+                continue
+            if isinstance(received, dict):
+                if "rollback" in received:
+                    self.start_rollback(received["rollback"])
+                    continue
+                if "sync" in received:
+                    if self.rollback:
+                        self.rollback.incoming.append(received)
+                    continue
+                if received.get("restart", False):
+                    self.reset_input()
+                    continue
+                if "resume" in received:
+                    # Повороты, ушедшие в оборванное соединение, уже не дойдут
+                    self.pending_inputs.clear()
+                    self.state = received["resume"]
+                    self.confirm_input(self.state)
                     self.game_over = self.state.get("game_over", False)
+                    self.resumed = True
+                    continue
+                if "session" in received:
+                    self.session_token = received["session"]
+                    self.rollback_mode = received.get("rollback_mode", False)
+                    continue
+                if "board" in received:
+                    self.board = received["board"]
+                    continue
+
+                self.state = received
+                self.confirm_input(received)
+                self.game_over = self.state.get("game_over", False)
+        return True
+
+    def confirm_input(self, state):
+        # Сверка с вводом, который подтвердил сервер: в ожидании остаются
+        # только повороты, до него еще не дошедшие
+        if "input_seq" not in state:
+            return
+        self.pending_inputs = [turn for turn in self.pending_inputs if turn[0] > state["input_seq"]]
+        self.direction = state["turn2"]
+        self.queued = state["queued2"]
+
+    def poll_state(self):
+        # Чтение уже пришедших сообщений без ожидания; False при разрыве или молчании сервера
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.receive_state():
+                return False
+        self.connection.maybe_ping()
+        return time.perf_counter() - self.connection.last_receive <= CONNECTION_TIMEOUT
+
+    def start_rollback(self, start):
+        # Начало матча в режиме отката с общего снимка сервера на его поле
+        self.board = start.get("board", self.board)
+        game = Game(random.Random(), self.board)
+        snapshot, over_tick = start["snapshot"]
+        game.restore(snapshot)
+        self.rollback = Rollback(game, 2, start["tick"])
+        game.inputs2.extend(self.early_inputs)
+        self.early_inputs.clear()
+        self.state = game.game_state()
+        self.game_over = False
 
-                screen.fill(BLACK)
-                screen.blit(background_img, (0, GAME_AREA_TOP))
-                your_score(self.state.get("score1", 0), self.state.get("score2", 0))
-                draw_snake(self.state.get("snake1", []), 1)
-                draw_snake(self.state.get("snake2", []), 2)
-                screen.blit(food_img, self.state.get("food", [0, 0]))
-                pygame.display.update()
-                clock.tick(FPS)
-
-                if self.game_over:
-                    if game_over_sound:
-                        game_over_sound.play()
-                    winner = self.state.get("winner")
-                    score = self.state.get("score2", 0) if winner == player2_name else self.state.get("score1", 0)
-                    self.show_game_over_screen(winner, score)
-                    self.running = False
-                    break
-                    
-            except (ConnectionError, pickle.UnpicklingError):
+    def rollback_tick(self):
+        # Тик клиента в режиме отката: свой ввод виден сразу, сервер не ждем
+        if self.game_over:
+            return
+        message = self.rollback.advance()
+        if message:
+            try:
+                self.connection.send(message)
+            except OSError:
                 self.error_msg = "Ошибка соединения с сервером"
                 self.running = False
-                break
-            except Exception as e:
-                print(f"Ошибка в клиенте: {e}")
-                self.error_msg = "Неизвестная ошибка"
-                self.running = False
-                break
+        state = self.rollback.game.game_state()
+        # Окончание матча засчитывает только сервер
+        state["game_over"] = False
+        self.state = state
+
+    def reset_input(self):
+        # Сброс направления перед новым матчем
+        self.game_over = False
+        self.direction = [-SNAKE_BLOCK, 0]
+        self.queued = 0
+        self.pending_inputs = []
+        self.rollback = None
+        self.early_inputs.clear()
+
+    def send_input(self, direction):
+        # Отправка поворота с порядковым номером по тем же правилам, что у очереди
+        # сервера: сверка идет с подтвержденным им вводом и еще не дошедшими поворотами
+        if self.rollback:
+            # В режиме отката поворот ставится в свою очередь и уходит с тиком
+            if not self.game_over:
+                game = self.rollback.game
+                queue_input(game.inputs2, direction, game.dir2)
+            return
+        if self.rollback_mode:
+            # Снимок еще в пути: поворот без номера тика сервер принял бы
+            # за ввод отката, поэтому он ждет начала матча
+            queue_input(self.early_inputs, direction, self.direction)
+            return
+        last = self.pending_inputs[-1][1] if self.pending_inputs else self.direction
+        if self.game_over or direction == last or direction == [-last[0], -last[1]]:
+            return
+        if self.queued + len(self.pending_inputs) >= INPUT_QUEUE_LIMIT:
+            return
+        self.input_seq += 1
+        self.pending_inputs.append((self.input_seq, list(direction)))
+        try:
+            self.connection.send((self.input_seq, direction[0], direction[1]))
+        except OSError:
+            self.error_msg = "Ошибка соединения с сервером"
+            self.running = False
 
+    def request_restart(self):
+        # Запрос перезапуска игры у сервера
+        try:
+            self.connection.send({"request_restart": True})
+            return True
+        except (ConnectionError, AttributeError):
+            self.error_msg = "Не удалось отправить запрос серверу"
+            return False
+
+    def get_stats(self):
+        # Сетевые метрики соединения с сервером
+        if not self.connection:
+            return {}
+        stats = self.connection.stats.snapshot()
+        if self.rollback:
+            stats.update(self.rollback.get_stats())
+        return stats
+
+    def safe_close(self):
+        # Безопасное закрытие соединения
         if self.sock:
             try:
                 self.sock.close()
             except:
                 pass
+        self.running = False
 
-    def show_game_over_screen(self, winner=None, score=None):
-        # Отображение экрана окончания игры
-        if background_music and background_music.get_num_channels() > 0:
+
+class Spectator(Client):
+    # Клиент-наблюдатель: только получает состояние матча
+    role = "spectator"
+
+
+class Profiler:
+    # Замер cProfile и tracemalloc на N секунд или N кадров; у каждой сцены
+    # (меню, ожидание, матч, конец игры) свой профиль и свои снимки памяти
+    def __init__(self, seconds=None, frames=None):
+        self.seconds = seconds
+        self.frames = frames
+        self.started = time.perf_counter()
+        self.stamp = time.strftime("%Y%m%d_%H%M%S")
+        self.count = 0
+        self.profiles = {}
+        # Рост памяти по строкам кода за все посещения сцены и снимки последнего из них
+        self.growth = {}
+        self.visits = {}
+        self.snapshots = {}
+        self.entry = None
+        self.label = None
+        self.own_tracing = not tracemalloc.is_tracing()
+        if self.own_tracing:
+            tracemalloc.start()
+
+    @staticmethod
+    def from_spec(spec):
+        # Разбор SNAKE_PROFILE: секунды ("10") или кадры ("300t")
+        try:
+            if spec.endswith("t"):
+                return Profiler(frames=int(spec[:-1]))
+            return Profiler(seconds=float(spec))
+        except ValueError:
+            print(f"Неверное значение SNAKE_PROFILE: {spec}")
+            return None
+
+    def switch(self, label):
+        # Смена сцены: профиль прежней останавливается, у новой начинается посещение
+        if self.label:
+            self.leave()
+        self.label = label
+        if label not in self.profiles:
+            self.profiles[label] = cProfile.Profile()
+        self.visits[label] = self.visits.get(label, 0) + 1
+        self.entry = tracemalloc.take_snapshot()
+        self.profiles[label].enable()
+
+    def leave(self):
+        # Конец посещения сцены: рост памяти от входа до выхода добавляется к сумме
+        # сцены, так что в нее не попадает то, что выделили другие сцены
+        self.profiles[self.label].disable()
+        exit_snapshot = tracemalloc.take_snapshot()
+        own = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        growth = self.growth.setdefault(self.label, {})
+        for stat in exit_snapshot.filter_traces(own).compare_to(self.entry.filter_traces(own), "lineno"):
+            if stat.size_diff or stat.count_diff:
+                total = growth.setdefault(stat.traceback, [0, 0])
+                total[0] += stat.size_diff
+                total[1] += stat.count_diff
+        self.snapshots[self.label] = (self.entry, exit_snapshot)
+
+    def frame(self, scene):
+        # Начало кадра; False, когда замер пора завершать
+        if scene.name != self.label:
+            self.switch(scene.name)
+        self.count += 1
+        if self.frames is not None:
+            return self.count <= self.frames
+        return time.perf_counter() - self.started < self.seconds
+
+    def finish(self):
+        # Остановка замера и запись файлов: .prof для pstats/snakeviz,
+        # снимки .tracemalloc последнего посещения и краткая сводка .txt по каждой сцене
+        if self.label:
+            self.leave()
+        if self.own_tracing:
+            tracemalloc.stop()
+        PROFILES_DIR.mkdir(exist_ok=True)
+        for label, profile in self.profiles.items():
+            base = PROFILES_DIR / f"profile_{self.stamp}_{label}"
+            profile.dump_stats(f"{base}.prof")
+            first, last = self.snapshots[label]
+            first.dump(f"{base}_start.tracemalloc")
+            last.dump(f"{base}_end.tracemalloc")
+
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(25)
+            report.write(f"Рост памяти за время сцены (посещений: {self.visits[label]}):\n")
+            growth = sorted(self.growth[label].items(), key=lambda item: abs(item[1][0]), reverse=True)
+            for traceback, (size, count) in growth[:15]:
+                report.write(f"{traceback}: size={size / 1024:+.1f} KiB, count={count:+d}\n")
+            with open(f"{base}.txt", "w", encoding="utf-8") as f:
+                f.write(report.getvalue())
+        print(f"Профиль записан в {PROFILES_DIR} ({self.count} кадров)")
+
+
+class Scene:
+    # Базовая сцена: обработка событий, логика и отрисовка одного кадра
+    fps = 30
+    name = "scene"
+
+    def __init__(self, session=None):
+        self.stack = None
+        self.session = session
+
+    def enter(self):
+        # Сцена стала активной
+        pass
+
+    def handle_event(self, event):
+        # Обработка одного события pygame
+        pass
+
+    def update(self):
+        # Логика одного кадра
+        pass
+
+    def draw(self):
+        # Отрисовка одного кадра
+        pass
+
+    def take_session(self):
+        # Передача сетевой сессии следующей сцене
+        session, self.session = self.session, None
+        return session
+
+    def close(self):
+        # Освобождение ресурсов при уходе сцены со стека
+        if self.session:
+            self.session.safe_close()
+            self.session = None
+
+
+class SceneStack:
+    # Стек сцен с явными переходами вместо рекурсивных вызовов
+    def __init__(self):
+        self.scenes = []
+
+    @property
+    def top(self):
+        return self.scenes[-1] if self.scenes else None
+
+    def push(self, scene):
+        # Переход на новую сцену поверх текущей
+        scene.stack = self
+        self.scenes.append(scene)
+        scene.enter()
+
+    def pop(self):
+        # Возврат к предыдущей сцене
+        scene = self.scenes.pop()
+        scene.close()
+        scene.stack = None
+        if self.scenes:
+            self.scenes[-1].enter()
+
+    def replace(self, scene):
+        # Замена текущей сцены
+        old = self.scenes.pop()
+        old.close()
+        old.stack = None
+        self.push(scene)
+
+    def reset(self, scene):
+        # Очистка стека и переход на сцену (например, в главное меню)
+        self.clear()
+        self.push(scene)
+
+    def clear(self):
+        # Закрытие всех сцен
+        while self.scenes:
+            scene = self.scenes.pop()
+            scene.close()
+            scene.stack = None
+
+
+def draw_background():
+    # Черный экран с фоном игрового поля
+    screen.fill(BLACK)
+    screen.blit(background_img, (0, GAME_AREA_TOP))
+
+
+def game_over_elements(winner, score):
+    # Надписи экрана окончания игры: победитель, очки и таблица рекордов
+    elements = []
+    if winner:
+        win_text = font_end.render(f"Победил {winner}!", True, YELLOW)
+        win_rect = win_text.get_rect(center=(SCREEN_WIDTH//2, 150))
+        elements.append((win_text, win_rect))
+
+        score_text = font_score.render(f"Очки: {score}", True, YELLOW)
+        score_rect = score_text.get_rect(center=(SCREEN_WIDTH//2, 200))
+        elements.append((score_text, score_rect))
+
+    highscores = load_highscores()
+    if highscores:
+        top_text = font_score.render("Топ игроков:", True, WHITE)
+        top_rect = top_text.get_rect(center=(SCREEN_WIDTH//2, 250))
+        elements.append((top_text, top_rect))
+
+        for i, (win, s) in enumerate(highscores[:5]):
+            entry = font_leader.render(f"{i+1}. {win} - {s}", True, WHITE)
+            entry_rect = entry.get_rect(center=(SCREEN_WIDTH//2, 300 + i*30))
+            elements.append((entry, entry_rect))
+    return elements
+
+
+class MenuScene(Scene):
+    # Сцена с набором кнопок
+    title = None
+    name = "menu"
+
+    def __init__(self):
+        super().__init__()
+        self.buttons = []
+
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            for btn in self.buttons:
+                if btn.is_clicked(event.pos):
+                    self.on_click()
+                    btn.action()
+                    return
+
+    def on_click(self):
+        # Действие перед нажатием любой кнопки
+        pass
+
+    def draw(self):
+        draw_background()
+        if self.title:
+            title = font_score.render(self.title, True, YELLOW)
+            screen.blit(title, title.get_rect(center=(SCREEN_WIDTH // 2, 150)))
+        for btn in self.buttons:
+            btn.draw(screen)
+
+
+class MainMenuScene(MenuScene):
+    # Главное меню игры
+    title = "SnaKE II"
+
+    def __init__(self):
+        super().__init__()
+        w, h = 300, 70
+        x = SCREEN_WIDTH // 2 - w // 2
+        y = SCREEN_HEIGHT // 2 - h
+        self.buttons.append(Button("Играть", x, y, w, h, GREEN, lambda: self.stack.push(NetworkMenuScene())))
+        self.buttons.append(Button("Выход", x, y + 90, w, h, RED, lambda: self.stack.clear()))
+
+    def enter(self):
+        if background_music:
+            background_music.play(loops=-1)
+
+    def on_click(self):
+        if background_music:
             background_music.stop()
-        if game_over_sound:
-            game_over_sound.play()
 
-        elements = []
-        if winner:
-            win_text = font_end.render(f"Победил {winner}!", True, YELLOW)
-            win_rect = win_text.get_rect(center=(SCREEN_WIDTH//2, 150))
-            elements.append((win_text, win_rect))
 
-            score_text = font_score.render(f"Очки: {score}", True, YELLOW)
-            score_rect = score_text.get_rect(center=(SCREEN_WIDTH//2, 200))
-            elements.append((score_text, score_rect))
+class NetworkMenuScene(MenuScene):
+    # Меню сетевой игры
+    def __init__(self):
+        super().__init__()
+        w, h = 300, 70
+        x = SCREEN_WIDTH // 2 - w // 2
+        y = SCREEN_HEIGHT // 2 - h * 2
+        self.buttons.append(Button("Создать сервер", x, y, w, h, GREEN,
+                                   lambda: self.stack.push(InputIpPortScene("server", start_server))))
+        self.buttons.append(Button("Подключиться", x, y + 90, w, h, GREEN,
+                                   lambda: self.stack.push(InputIpPortScene("client", start_client))))
+        self.buttons.append(Button("Наблюдать", x, y + 180, w, h, GREEN,
+                                   lambda: self.stack.push(InputIpPortScene("client", start_spectator))))
+        self.buttons.append(Button("Назад", x, y + 270, w, h, YELLOW, lambda: self.stack.pop()))
+
+
+class InputIpPortScene(Scene):
+    # Ввод IP и порта для подключения
+    name = "menu"
+
+    def __init__(self, mode, start):
+        super().__init__()
+        self.mode = mode
+        self.start = start
+        self.ip, self.port, self.active = "", "", "ip"
+        self.input_rects = {
+            "ip": pygame.Rect(SCREEN_WIDTH // 2 - 150, 280, 300, 50),
+            "port": pygame.Rect(SCREEN_WIDTH // 2 - 150, 360, 300, 50)
+        }
+        self.back_btn = Button("Назад", SCREEN_WIDTH // 2 - 75, 430, 150, 50, YELLOW, lambda: self.stack.pop())
+        self.error_msg = ""
 
-        highscores = load_highscores()
-        if highscores:
-            top_text = font_score.render("Топ игроков:", True, WHITE)
-            top_rect = top_text.get_rect(center=(SCREEN_WIDTH//2, 250))
-            elements.append((top_text, top_rect))
+    def submit(self):
+        # Проверка введенных данных и переход к игре
+        if self.mode == "client":
+            try:
+                if self.ip != "localhost":
+                    socket.inet_aton(self.ip)
+            except socket.error:
+                self.error_msg = "Неверный формат IP-адреса (пример: 192.168.1.1)"
+                return
 
-            for i, (win, s) in enumerate(highscores[:5]):
-                entry = font_leader.render(f"{i+1}. {win} - {s}", True, WHITE)
-                entry_rect = entry.get_rect(center=(SCREEN_WIDTH//2, 300 + i*30))
-                elements.append((entry, entry_rect))
+        try:
+            port_num = int(self.port)
+        except ValueError:
+            self.error_msg = "Порт должен быть числом"
+            return
+        if not 0 < port_num <= 65535:
+            self.error_msg = "Порт должен быть от 1 до 65535"
+            return
+        self.stack.replace(self.start(self.ip, port_num))
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_RETURN:
+                if self.active == "ip":
+                    self.active = "port"
+                elif self.ip and self.port:
+                    self.submit()
+            elif event.key == pygame.K_BACKSPACE:
+                if self.active == "ip":
+                    self.ip = self.ip[:-1]
+                elif self.active == "port":
+                    self.port = self.port[:-1]
+                self.error_msg = ""
+            else:
+                if self.active == "ip":
+                    if event.unicode.isdigit() or event.unicode == '.' or (not self.ip and event.unicode.isalpha()):
+                        self.ip += event.unicode
+                elif self.active == "port" and event.unicode.isdigit():
+                    self.port += event.unicode
+                self.error_msg = ""
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            if self.input_rects["ip"].collidepoint(event.pos):
+                self.active = "ip"
+            elif self.input_rects["port"].collidepoint(event.pos):
+                self.active = "port"
+            elif self.back_btn.is_clicked(event.pos):
+                self.back_btn.action()
+
+    def draw(self):
+        draw_background()
+
+        if self.mode == "server":
+            label = font_score.render("Введите параметры для создания сервера", True, YELLOW)
+        else:
+            label = font_score.render("Введите параметры для подключения", True, YELLOW)
+        screen.blit(label, label.get_rect(center=(SCREEN_WIDTH // 2, 180)))
 
-        request_btn = Button("Запросить перезапуск", SCREEN_WIDTH//2 - 250, SCREEN_HEIGHT - 150, 320, 50, GREEN, self.request_restart)
-        exit_btn = Button("Выход", SCREEN_WIDTH//2 + 90, SCREEN_HEIGHT - 150, 200, 50, RED, self.exit_to_menu)
+        if self.error_msg:
+            error_text = font_score.render(self.error_msg, True, RED)
+            screen.blit(error_text, error_text.get_rect(center=(SCREEN_WIDTH // 2, 220)))
 
-        alpha = 0
-        fade_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-        fade_surface.fill(BLACK)
+        input_rects = self.input_rects
+        pygame.draw.rect(screen, DARK_GREEN, input_rects["ip"])
+        pygame.draw.rect(screen, DARK_GREEN, input_rects["port"])
+        pygame.draw.rect(screen, WHITE, input_rects[self.active], 2)
 
-        waiting = True
+        screen.blit(font_score.render("IP:", True, WHITE), (input_rects["ip"].x - 70, input_rects["ip"].y + 10))
+        screen.blit(font_score.render(self.ip, True, WHITE), (input_rects["ip"].x + 10, input_rects["ip"].y + 10))
+        screen.blit(font_score.render("Порт:", True, WHITE), (input_rects["port"].x - 112, input_rects["port"].y + 10))
+        screen.blit(font_score.render(self.port, True, WHITE), (input_rects["port"].x + 10, input_rects["port"].y + 10))
 
-        while waiting:
-            try:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        self.running = False
-                        waiting = False
-                    elif event.type == pygame.MOUSEBUTTONDOWN:
-                        pos = pygame.mouse.get_pos()
-                        if request_btn.is_clicked(pos):
-                            request_btn.action()
-                        elif exit_btn.is_clicked(pos):
-                            exit_btn.action()
-                            waiting = False
-
-                alpha = min(alpha + 5, 255)
-                fade_surface.set_alpha(255 - alpha)
-                screen.fill(BLACK)
-                screen.blit(background_img, (0, GAME_AREA_TOP))
-
-                for element, rect in elements:
-                    element.set_alpha(alpha)
-                    screen.blit(element, rect)
-
-                request_btn.draw(screen)
-                exit_btn.draw(screen)
-                screen.blit(fade_surface, (0, 0))
-
-                pygame.display.flip()
-                clock.tick(30)
-            except pygame.error:
-                self.running = False
-                waiting = False
+        self.back_btn.draw(screen)
 
-    def request_restart(self):
-        # Запрос перезапуска игры у сервера
-        if self.sock:
-            try:
-                self.sock.sendall(pickle.dumps({"request_restart": True}))
-                self.show_waiting_message()
-            except ConnectionError:
-                self.error_msg = "Не удалось отправить запрос серверу"
-                self.show_error_screen()
-
-    def show_waiting_message(self):
-        # Отображение сообщения об ожидании
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
-        
-        waiting_text = font_end.render("Ожидание сервера...", True, YELLOW)
-        info_text = font_score.render("Сервер должен подтвердить перезапуск", True, WHITE)
-        
-        screen.blit(waiting_text, waiting_text.get_rect(center=(SCREEN_WIDTH//2, 200)))
-        screen.blit(info_text, info_text.get_rect(center=(SCREEN_WIDTH//2, 250)))
-        
-        pygame.display.flip()
-        
-        waiting = True
-        while waiting and self.running:
-            try:
-                data = self.sock.recv(1024)
-                if data:
-                    received = pickle.loads(data)
-                    if isinstance(received, dict) and received.get("restart", False):
-                        waiting = False
-                        self.game_over = False
-                        self.run()
-                        return
-            except:
-                waiting = False
-        
-        self.error_msg = "Сервер не ответил на запрос"
-        self.show_error_screen()
 
-    def exit_to_menu(self):
-        # Выход в главное меню
-        self.safe_close()
-        main_menu()
+class ErrorScene(Scene):
+    # Экран с ошибкой; любая клавиша возвращает в главное меню
+    name = "error"
 
-    def safe_close(self):
-        # Безопасное закрытие соединения
-        if self.sock:
-            try:
-                self.sock.close()
-            except:
-                pass
-        self.running = False
+    def __init__(self, msg):
+        super().__init__()
+        self.msg = msg
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
+            self.stack.reset(MainMenuScene())
+
+    def draw(self):
+        draw_background()
 
-    def show_error_screen(self):
-        # Отображение экрана с ошибкой
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
-        
         error_text = font_end.render("Ошибка подключения", True, RED)
-        msg_text = font_score.render(self.error_msg, True, WHITE)
+        msg_text = font_score.render(self.msg, True, WHITE)
         back_text = font_score.render("Нажмите любую клавишу для возврата в меню", True, YELLOW)
-        
+
         screen.blit(error_text, error_text.get_rect(center=(SCREEN_WIDTH//2, 200)))
         screen.blit(msg_text, msg_text.get_rect(center=(SCREEN_WIDTH//2, 300)))
         screen.blit(back_text, back_text.get_rect(center=(SCREEN_WIDTH//2, 400)))
-        
-        pygame.display.flip()
-        
-        waiting = True
-        while waiting:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                    waiting = False
-        
-        main_menu()
 
 
-def input_ip_port(mode="server"):
-    # Ввод IP и порта для подключения
-    ip, port, active = "", "", "ip"
-    input_rects = {
-        "ip": pygame.Rect(SCREEN_WIDTH // 2 - 150, 280, 300, 50),
-        "port": pygame.Rect(SCREEN_WIDTH // 2 - 150, 360, 300, 50)
-    }
-    back_btn = Button("Назад", SCREEN_WIDTH // 2 - 75, 430, 150, 50, YELLOW, lambda: (None, None))
-    error_msg = ""
+class CountdownScene(Scene):
+    # Обратный отсчет перед началом игры, затем переход на следующую сцену
+    name = "countdown"
 
-    while True:
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
+    def __init__(self, next_scene, seconds=3):
+        super().__init__()
+        self.next_scene = next_scene
+        self.seconds = seconds
+        self.font = pygame.font.SysFont("comicsansms", 72)
+        self.started = None
 
-        if mode == "server":
-            label = font_score.render("Введите параметры для создания сервера", True, YELLOW)
-        else:
-            label = font_score.render("Введите параметры для подключения", True, YELLOW)
-        screen.blit(label, label.get_rect(center=(SCREEN_WIDTH // 2, 180)))
+    def enter(self):
+        self.started = pygame.time.get_ticks()
 
-        if error_msg:
-            error_text = font_score.render(error_msg, True, RED)
-            screen.blit(error_text, error_text.get_rect(center=(SCREEN_WIDTH // 2, 220)))
+    def update(self):
+        if pygame.time.get_ticks() - self.started >= self.seconds * 1000:
+            scene, self.next_scene = self.next_scene, None
+            self.stack.replace(scene)
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN:
-                    if active == "ip":
-                        active = "port"
-                    elif ip and port:
-                        if mode == "client":
-                            try:
-                                if ip != "localhost":
-                                    socket.inet_aton(ip)
-                            except socket.error:
-                                error_msg = "Неверный формат IP-адреса (пример: 192.168.1.1)"
-                                continue
-                        
-                        try:
-                            port_num = int(port)
-                            if not 0 < port_num <= 65535:
-                                error_msg = "Порт должен быть от 1 до 65535"
-                                continue
-                            return ip, port_num
-                        except ValueError:
-                            error_msg = "Порт должен быть числом"
-                            continue
-                elif event.key == pygame.K_BACKSPACE:
-                    if active == "ip":
-                        ip = ip[:-1]
-                    elif active == "port":
-                        port = port[:-1]
-                    error_msg = ""
-                else:
-                    if active == "ip":
-                        if event.unicode.isdigit() or event.unicode == '.' or (not ip and event.unicode.isalpha()):
-                            ip += event.unicode
-                    elif active == "port" and event.unicode.isdigit():
-                        port += event.unicode
-                    error_msg = ""
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if input_rects["ip"].collidepoint(event.pos):
-                    active = "ip"
-                elif input_rects["port"].collidepoint(event.pos):
-                    active = "port"
-                elif back_btn.is_clicked(event.pos):
-                    return None, None
+    def draw(self):
+        draw_background()
+        left = self.seconds - (pygame.time.get_ticks() - self.started) // 1000
+        text = self.font.render(str(max(left, 1)), True, YELLOW)
+        screen.blit(text, text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)))
 
-        pygame.draw.rect(screen, DARK_GREEN, input_rects["ip"])
-        pygame.draw.rect(screen, DARK_GREEN, input_rects["port"])
+    def close(self):
+        if self.next_scene:
+            self.next_scene.close()
+            self.next_scene = None
 
-        if active == "ip":
-            pygame.draw.rect(screen, WHITE, input_rects["ip"], 2)
-        else:
-            pygame.draw.rect(screen, WHITE, input_rects["port"], 2)
 
-        screen.blit(font_score.render("IP:", True, WHITE), (input_rects["ip"].x - 70, input_rects["ip"].y + 10))
-        screen.blit(font_score.render(ip, True, WHITE), (input_rects["ip"].x + 10, input_rects["ip"].y + 10))
-        screen.blit(font_score.render("Порт:", True, WHITE), (input_rects["port"].x - 112, input_rects["port"].y + 10))
-        screen.blit(font_score.render(port, True, WHITE), (input_rects["port"].x + 10, input_rects["port"].y + 10))
+class ServerWaitScene(Scene):
+    # Ожидание подключения клиента
+    name = "waiting"
 
-        back_btn.draw(screen)
-        pygame.display.update()
-        clock.tick(30)
+    def __init__(self, server):
+        super().__init__(server)
+        self.cancel_btn = Button("Отмена", SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT - 100, 200, 50, YELLOW,
+                                 lambda: self.stack.reset(MainMenuScene()))
 
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN and self.cancel_btn.is_clicked(event.pos):
+            self.cancel_btn.action()
 
-def network_game_menu():
-    # Меню сетевой игры
-    buttons = []
-    w, h = 300, 70
-    x = SCREEN_WIDTH // 2 - w // 2
-    y = SCREEN_HEIGHT // 2 - h * 2
-    buttons.append(Button("Создать сервер", x, y, w, h, GREEN, start_server_menu))
-    buttons.append(Button("Подключиться", x, y + 90, w, h, GREEN, start_client_menu))
-    buttons.append(Button("Назад", x, y + 180, w, h, YELLOW, main_menu))
+    def update(self):
+        try:
+            if self.session.accept_player():
+                self.stack.replace(CountdownScene(ServerMatchScene(self.take_session())))
+        except Exception as e:
+            print(f"Ошибка подключения: {e}")
+            self.stack.replace(ErrorScene(f"Ошибка подключения: {e}"))
+
+    def draw(self):
+        draw_background()
+
+        title = font_score.render("Ожидание подключения...", True, WHITE)
+        ip_text = font_score.render(f"IP: {self.session.ip}", True, WHITE)
+        port_text = font_score.render(f"Порт: {self.session.port}", True, WHITE)
+
+        screen.blit(title, title.get_rect(center=(SCREEN_WIDTH // 2, 200)))
+        screen.blit(ip_text, ip_text.get_rect(center=(SCREEN_WIDTH // 2, 250)))
+        screen.blit(port_text, port_text.get_rect(center=(SCREEN_WIDTH // 2, 300)))
+
+        self.cancel_btn.draw(screen)
+
+
+class ServerMatchScene(Scene):
+    # Игровой матч на стороне сервера
+    fps = FPS
+    name = "match"
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.camera = Camera()
+
+    def enter(self):
+        self.session.start_match()
+
+    def handle_event(self, event):
+        server = self.session
+        if event.type == pygame.KEYDOWN:
+            if event.key in KEY_DIRECTIONS:
+                queue_input(server.inputs1, KEY_DIRECTIONS[event.key], server.dir1)
+            elif event.key == pygame.K_F3:
+                server.show_stats = not server.show_stats
+
+    def update(self):
+        server = self.session
+        if server.match_over():
+            server.stop_recording()
+            if server.winner != "Ничья?":
+                save_score(server.winner, max(server.score1, server.score2))
+            score = max(server.score1, server.score2)
+            self.stack.replace(ServerGameOverScene(self.take_session(), server.winner, score))
+            return
 
-    while True:
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
+        server.accept_pending()
+        server.check_player()
+        if server.connection is None:
+            # Матч на паузе, пока игрок не вернется
+            if time.perf_counter() - server.lost_at > RECONNECT_GRACE:
+                self.stack.replace(ErrorScene("Соединение с клиентом разорвано"))
+            return
+        server.tick()
+
+    def draw(self):
+        server = self.session
+        board = [BOARD_WIDTH, BOARD_HEIGHT]
+        self.camera.follow(server.snake1[-1], board)
+        draw_state({
+            "snake1": server.snake1,
+            "snake2": server.snake2,
+            "food": server.food,
+            "score1": server.score1,
+            "score2": server.score2,
+        }, camera=self.camera, board=board)
+        if server.connection is None:
+            left = RECONNECT_GRACE - (time.perf_counter() - server.lost_at)
+            text = font_score.render(f"Игрок отключился, ожидание: {max(left, 0):.0f} с", True, YELLOW)
+            screen.blit(text, text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)))
+        elif server.show_stats:
+            draw_net_stats(server.connection.stats, server.rollback)
+
+
+class GameOverScene(Scene):
+    # Экран окончания игры с плавным появлением
+    name = "game-over"
+
+    def __init__(self, session, winner=None, score=None):
+        super().__init__(session)
+        self.elements = game_over_elements(winner, score)
+        self.buttons = []
+        self.alpha = 0
+        self.fade_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+        self.fade_surface.fill(BLACK)
+
+    def enter(self):
+        if background_music and background_music.get_num_channels() > 0:
+            background_music.stop()
+        if game_over_sound:
+            game_over_sound.play()
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for btn in buttons:
-                    if btn.is_clicked(event.pos):
-                        btn.action()
-                        return
-
-        for btn in buttons:
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            for btn in self.buttons:
+                if btn.is_clicked(event.pos):
+                    btn.action()
+                    return
+
+    def exit_to_menu(self):
+        # Выход в главное меню
+        self.stack.reset(MainMenuScene())
+
+    def draw(self):
+        self.alpha = min(self.alpha + 5, 255)
+        self.fade_surface.set_alpha(255 - self.alpha)
+        draw_background()
+
+        for element, rect in self.elements:
+            element.set_alpha(self.alpha)
+            screen.blit(element, rect)
+
+        for btn in self.buttons:
             btn.draw(screen)
-        pygame.display.update()
-        clock.tick(30)
+        screen.blit(self.fade_surface, (0, 0))
+
+
+class ServerGameOverScene(GameOverScene):
+    # Экран окончания игры на сервере: ждет запроса перезапуска от клиента
+    def __init__(self, server, winner=None, score=None):
+        super().__init__(server, winner, score)
+        self.buttons.append(Button("Выход", SCREEN_WIDTH//2 + 20, SCREEN_HEIGHT - 150, 200, 50, RED, self.exit_to_menu))
+
+    def update(self):
+        server = self.session
+        if server.restart_requested:
+            server.restart_game()
+            self.stack.replace(CountdownScene(ServerMatchScene(self.take_session())))
+
+
+class ClientMatchScene(Scene):
+    # Игровой матч на стороне клиента
+    fps = FPS
+    name = "match"
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.camera = Camera()
+
+    def enter(self):
+        self.session.sock.settimeout(CONNECTION_TIMEOUT)
+
+    def handle_event(self, event):
+        client = self.session
+        if event.type == pygame.KEYDOWN:
+            if event.key in KEY_DIRECTIONS:
+                client.send_input(KEY_DIRECTIONS[event.key])
+            elif event.key == pygame.K_F3:
+                client.show_stats = not client.show_stats
+
+    def update(self):
+        client = self.session
+        if client.game_over:
+            winner = client.state.get("winner")
+            score = client.state.get("score2", 0) if winner == player2_name else client.state.get("score1", 0)
+            self.stack.replace(ClientGameOverScene(self.take_session(), winner, score))
+            return
 
+        try:
+            if client.rollback:
+                if client.running and not client.poll_state():
+                    client.error_msg = "Соединение с сервером разорвано"
+                    client.running = False
+                elif client.rollback:
+                    client.rollback_tick()
+            # Ожидание очередного состояния, затем все, что уже пришло: на большом
+            # поле кадр длиннее одного recv, и клиент иначе отстает от сервера
+            elif client.running and not (client.receive_state() and client.poll_state()):
+                client.error_msg = "Соединение с сервером разорвано"
+                client.running = False
+        except (socket.timeout, ConnectionError, pickle.UnpicklingError):
+            client.error_msg = "Ошибка соединения с сервером"
+            client.running = False
+        except Exception as e:
+            print(f"Ошибка в клиенте: {e}")
+            client.error_msg = "Неизвестная ошибка"
+            client.running = False
 
-def start_server_menu():
-    # Запуск сервера
-    ip, port = input_ip_port("server")
-    if ip is None and port is None:
-        network_game_menu()
-    elif ip is not None and port is not None:
-        server = Server(ip, port)
-        if server.running and hasattr(server, 'conn') and server.conn:
-            server.run()
+        if not client.running:
+            if client.session_token:
+                self.stack.replace(ReconnectScene(self.take_session()))
+            else:
+                self.stack.replace(ErrorScene(client.error_msg))
+
+    def draw(self):
+        client = self.session
+        snake2 = client.state.get("snake2")
+        if snake2:
+            self.camera.follow(snake2[-1], client.board)
+        draw_state(client.state, camera=self.camera, board=client.board)
+        if client.show_stats:
+            draw_net_stats(client.connection.stats, client.rollback)
+
+
+class ReconnectScene(Scene):
+    # Переподключение к идущему матчу после обрыва связи
+    name = "waiting"
+
+    def enter(self):
+        self.started = time.perf_counter()
+        self.last_attempt = 0.0
+
+    def update(self):
+        client = self.session
+        now = time.perf_counter()
+        if now - self.started > RECONNECT_GRACE:
+            self.stack.replace(ErrorScene(client.error_msg))
+            return
+        if now - self.last_attempt < RECONNECT_INTERVAL:
+            return
+        self.last_attempt = now
+        if client.reconnect():
+            self.stack.replace(ClientMatchScene(self.take_session()))
 
+    def draw(self):
+        draw_background()
 
-def start_client_menu():
-    # Подключение к серверу
-    ip, port = input_ip_port("client")
-    if ip is None and port is None:
-        network_game_menu()
-    elif ip is not None and port is not None:
-        client = Client(ip, port)
-        if client.running:
-            client.run()
+        left = RECONNECT_GRACE - (time.perf_counter() - self.started)
+        title = font_end.render("Переподключение...", True, YELLOW)
+        info_text = font_score.render(f"Матч продолжится после восстановления связи ({max(left, 0):.0f} с)",
+                                      True, WHITE)
 
+        screen.blit(title, title.get_rect(center=(SCREEN_WIDTH//2, 200)))
+        screen.blit(info_text, info_text.get_rect(center=(SCREEN_WIDTH//2, 260)))
 
-def main_menu():
-    # Главное меню игры
-    if background_music:
-        background_music.play(loops=-1)
-    buttons = []
-    w, h = 300, 70
-    x = SCREEN_WIDTH // 2 - w // 2
-    y = SCREEN_HEIGHT // 2 - h
-    buttons.append(Button("Играть", x, y, w, h, GREEN, network_game_menu))
-    buttons.append(Button("Выход", x, y + 90, w, h, RED, lambda: sys.exit()))
 
-    while True:
-        screen.fill(BLACK)
-        screen.blit(background_img, (0, GAME_AREA_TOP))
-        title = font_score.render("SnaKE II", True, YELLOW)
-        screen.blit(title, title.get_rect(center=(SCREEN_WIDTH // 2, 150)))
+class ClientGameOverScene(GameOverScene):
+    # Экран окончания игры на клиенте с запросом перезапуска
+    def __init__(self, client, winner=None, score=None):
+        super().__init__(client, winner, score)
+        self.buttons.append(Button("Запросить перезапуск", SCREEN_WIDTH//2 - 250, SCREEN_HEIGHT - 150, 320, 50, GREEN,
+                                   self.request_restart))
+        self.buttons.append(Button("Выход", SCREEN_WIDTH//2 + 90, SCREEN_HEIGHT - 150, 200, 50, RED, self.exit_to_menu))
+
+    def request_restart(self):
+        # Запрос перезапуска игры у сервера
+        client = self.session
+        if client.request_restart():
+            self.stack.replace(WaitingRestartScene(self.take_session()))
+        else:
+            self.stack.replace(ErrorScene(client.error_msg))
+
+
+class WaitingRestartScene(Scene):
+    # Ожидание подтверждения перезапуска от сервера
+    name = "waiting"
+
+    def enter(self):
+        self.session.sock.settimeout(0.05)
 
+    def update(self):
+        client = self.session
+        try:
+            if not client.receive_state():
+                raise ConnectionError
+        except socket.timeout:
+            return
+        except Exception:
+            client.error_msg = "Сервер не ответил на запрос"
+            self.stack.replace(ErrorScene(client.error_msg))
+            return
+
+        if not client.game_over:
+            client.sock.settimeout(None)
+            self.stack.replace(CountdownScene(ClientMatchScene(self.take_session())))
+
+    def draw(self):
+        draw_background()
+
+        waiting_text = font_end.render("Ожидание сервера...", True, YELLOW)
+        info_text = font_score.render("Сервер должен подтвердить перезапуск", True, WHITE)
+
+        screen.blit(waiting_text, waiting_text.get_rect(center=(SCREEN_WIDTH//2, 200)))
+        screen.blit(info_text, info_text.get_rect(center=(SCREEN_WIDTH//2, 250)))
+
+
+class SpectatorScene(Scene):
+    # Наблюдение за матчем; TAB переключает камеру между игроками
+    name = "match"
+
+    def __init__(self, spectator):
+        super().__init__(spectator)
+        self.camera = Camera()
+        self.follow = "snake1"
+
+    def enter(self):
+        self.session.sock.settimeout(0.5)
+
+    def handle_event(self, event):
+        spectator = self.session
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.stack.reset(MainMenuScene())
+            elif event.key == pygame.K_TAB:
+                self.follow = "snake2" if self.follow == "snake1" else "snake1"
+            elif event.key == pygame.K_F3:
+                spectator.show_stats = not spectator.show_stats
+
+    def update(self):
+        spectator = self.session
+        try:
+            if not (spectator.receive_state() and spectator.poll_state()):
+                spectator.error_msg = "Соединение с сервером разорвано"
+                spectator.running = False
+        except socket.timeout:
+            pass
+        except (ConnectionError, pickle.UnpicklingError):
+            spectator.error_msg = "Ошибка соединения с сервером"
+            spectator.running = False
+        except Exception as e:
+            print(f"Ошибка в наблюдателе: {e}")
+            spectator.error_msg = "Неизвестная ошибка"
+            spectator.running = False
+
+        if not spectator.running:
+            self.stack.replace(ErrorScene(spectator.error_msg))
+
+    def draw(self):
+        spectator = self.session
+        followed = spectator.state.get(self.follow)
+        if followed:
+            self.camera.follow(followed[-1], spectator.board)
+        draw_state(spectator.state, camera=self.camera, board=spectator.board)
+        if spectator.show_stats:
+            draw_net_stats(spectator.connection.stats)
+        if spectator.state.get("game_over"):
+            win_text = font_end.render(f"Победил {spectator.state.get('winner')}!", True, YELLOW)
+            screen.blit(win_text, win_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)))
+
+
+def start_server(ip, port):
+    # Создание сервера и переход к ожиданию подключения
+    server = Server(ip, port)
+    if not server.running:
+        return ErrorScene(server.error_msg)
+    return ServerWaitScene(server)
+
+
+def start_client(ip, port):
+    # Подключение к серверу в роли игрока
+    client = Client(ip, port)
+    if not client.running:
+        return ErrorScene(client.error_msg)
+    return CountdownScene(ClientMatchScene(client))
+
+
+def start_spectator(ip, port):
+    # Подключение к серверу в роли наблюдателя
+    spectator = Spectator(ip, port)
+    if not spectator.running:
+        return ErrorScene(spectator.error_msg)
+    return SpectatorScene(spectator)
+
+
+def run_game(scene):
+    # Единственный главный цикл: каждый кадр обрабатывает верхнюю сцену стека
+    stack = SceneStack()
+    stack.push(scene)
+    profiler = Profiler.from_spec(PROFILE_SPEC) if PROFILE_SPEC else None
+    while stack.scenes:
+        scene = stack.top
+        if profiler and not profiler.frame(scene):
+            profiler.finish()
+            profiler = None
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for btn in buttons:
-                    if btn.is_clicked(event.pos):
-                        if background_music:
-                            background_music.stop()
-                        btn.action()
-                        return
-
-        for btn in buttons:
-            btn.draw(screen)
-        pygame.display.update()
-        clock.tick(30)
+                stack.clear()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F9:
+                if profiler is None:
+                    profiler = Profiler(seconds=PROFILE_SECONDS)
+            elif stack.top is scene:
+                scene.handle_event(event)
+        if stack.top is scene:
+            scene.update()
+        if stack.top is scene:
+            scene.draw()
+            pygame.display.update()
+            clock.tick(scene.fps)
+    if profiler:
+        profiler.finish()
+    pygame.quit()
+    sys.exit()
 
 
 if __name__ == "__main__":
-    main_menu()
\ No newline at end of file
+    run_game(MainMenuScene())
@@ -0,0 +1,352 @@
+import os
+
+# Матчи идут без окна и звука: переменные нужно задать до импорта pygame
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import random
+import sys
+import time
+from itertools import permutations
+from multiprocessing import Pool
+
+# Размер поля читается snake при импорте, поэтому --board применяется заранее
+# (дочерние процессы пула наследуют окружение)
+if __name__ == "__main__":
+    for i, arg in enumerate(sys.argv):
+        if arg == "--board" and i + 1 < len(sys.argv):
+            os.environ["SNAKE_BOARD"] = sys.argv[i + 1]
+        elif arg.startswith("--board="):
+            os.environ["SNAKE_BOARD"] = arg.split("=", 1)[1]
+
+import snake
+
+DIRECTIONS = [[snake.SNAKE_BLOCK, 0], [-snake.SNAKE_BLOCK, 0],
+              [0, snake.SNAKE_BLOCK], [0, -snake.SNAKE_BLOCK]]
+
+
+def is_free(game, pos):
+    # Клетка внутри поля и не занята ни одной змейкой
+    if (pos[0] < 0 or pos[0] >= snake.BOARD_WIDTH or
+            pos[1] < snake.GAME_AREA_TOP or pos[1] >= snake.BOARD_HEIGHT):
+        return False
+    return pos not in game.snake1 and pos not in game.snake2
+
+
+def safe_directions(game, head, current):
+    # Повороты, после которых змейка не врежется на следующем тике
+    result = []
+    for direction in DIRECTIONS:
+        if direction == [-current[0], -current[1]]:
+            continue
+        if is_free(game, [head[0] + direction[0], head[1] + direction[1]]):
+            result.append(direction)
+    return result
+
+
+def bot_straight(game, head, current, rng):
+    # Никогда не поворачивает: нижняя планка для сравнения
+    return None
+
+
+def bot_random(game, head, current, rng):
+    # Изредка поворачивает в случайную сторону
+    if rng.random() < 0.2:
+        return rng.choice(DIRECTIONS)
+    return None
+
+
+def bot_cautious(game, head, current, rng):
+    # Едет прямо, пока можно, иначе выбирает случайный безопасный поворот
+    options = safe_directions(game, head, current)
+    if current in options or not options:
+        return None
+    return rng.choice(options)
+
+
+def bot_greedy(game, head, current, rng):
+    # Безопасный поворот, сильнее всего приближающий к еде
+    options = safe_directions(game, head, current)
+    if not options:
+        return None
+    return min(options, key=lambda d: abs(head[0] + d[0] - game.food[0]) + abs(head[1] + d[1] - game.food[1]))
+
+
+BOTS = {
+    "straight": bot_straight,
+    "random": bot_random,
+    "cautious": bot_cautious,
+    "greedy": bot_greedy,
+}
+
+
+def spawn_mirrored(game):
+    # Симметричный старт: змейки на одной линии лицом друг к другу, еда случайно
+    width, height = game.board
+    cols = width // snake.SNAKE_BLOCK
+    top = snake.GAME_AREA_TOP // snake.SNAKE_BLOCK
+    rows = height // snake.SNAKE_BLOCK
+    y = (top + (rows - top) // 2) * snake.SNAKE_BLOCK
+    game.snake1 = [[(cols // 4) * snake.SNAKE_BLOCK, y]]
+    game.snake2 = [[(cols - 1 - cols // 4) * snake.SNAKE_BLOCK, y]]
+    game.food = snake.new_food_position(game.snake1, game.snake2, game.rng, game.board)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    # Процентили отсортированного ряда (ближайший ранг)
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f"p{p}": values[min(len(values) - 1, len(values) * p // 100)] for p in points}
+    result["mean"] = sum(values) / len(values)
+    result["max"] = values[-1]
+    return result
+
+
+def histogram_percentiles(hist, points=(50, 90, 99)):
+    # Процентили по гистограмме {значение: количество}
+    total = sum(hist.values())
+    if not total:
+        return {}
+    result = {}
+    keys = sorted(hist)
+    for p in points:
+        rank = min(total - 1, total * p // 100)
+        seen = 0
+        for key in keys:
+            seen += hist[key]
+            if seen > rank:
+                result[f"p{p}"] = key
+                break
+    result["mean"] = sum(k * c for k, c in hist.items()) / total
+    result["max"] = keys[-1]
+    return result
+
+
+def play_match(task):
+    # Один полный матч двух ботов на правилах сервера, без сети и отрисовки
+    match_id, bot1, bot2, seed, spawn, max_ticks = task
+    rng = random.Random(seed)
+    game = snake.Game(random.Random(rng.random()))
+    if spawn == "mirrored":
+        spawn_mirrored(game)
+    controllers = ((BOTS[bot1], game.inputs1, 1), (BOTS[bot2], game.inputs2, 2))
+
+    # Время тика копится гистограммой по микросекундам, а не списком:
+    # в главный процесс уходит несколько чисел вместо тысяч
+    tick_hist = {}
+    bot_time = 0
+    ticks = 0
+    while not game.game_over and ticks < max_ticks:
+        started = time.perf_counter_ns()
+        for controller, inputs, player in controllers:
+            body = game.snake1 if player == 1 else game.snake2
+            current = inputs[-1] if inputs else (game.dir1 if player == 1 else game.dir2)
+            direction = controller(game, body[-1], current, rng)
+            if direction:
+                snake.queue_input(inputs, direction, current)
+        stepped = time.perf_counter_ns()
+        game.step()
+        us = (time.perf_counter_ns() - stepped) // 1000
+        tick_hist[us] = tick_hist.get(us, 0) + 1
+        bot_time += stepped - started
+        ticks += 1
+
+    if not game.game_over:
+        result = "timeout"
+    elif game.winner == snake.player1_name:
+        result = "1"
+    elif game.winner == snake.player2_name:
+        result = "2"
+    else:
+        result = "draw"
+    return {
+        "id": match_id,
+        "bot1": bot1,
+        "bot2": bot2,
+        "seed": seed,
+        "result": result,
+        "ticks": ticks,
+        "score1": game.score1,
+        "score2": game.score2,
+        "tick_us": tick_hist,
+        "bot_ns": bot_time,
+    }
+
+
+def round_robin(bots, rounds, seed, spawn, max_ticks):
+    # Каждый с каждым на обеих стартовых позициях, rounds раз
+    pairs = list(permutations(bots, 2))
+    return [[(i * len(pairs) + j, a, b, seed + i * len(pairs) + j, spawn, max_ticks)
+             for j, (a, b) in enumerate(pairs)]
+            for i in range(rounds)]
+
+
+def swiss_pairs(bots, points, played, byes):
+    # Пары очередного тура по швейцарской системе: соседи по очкам без повторов;
+    # при нечетном числе ботов последний по очкам, кто еще не отдыхал, получает бай
+    order = sorted(bots, key=lambda b: -points[b])
+    bye = None
+    if len(order) % 2:
+        bye = next((b for b in reversed(order) if b not in byes), order[-1])
+        order.remove(bye)
+    pairs = []
+    while len(order) > 1:
+        first = order.pop(0)
+        partner = next((b for b in order if frozenset((first, b)) not in played), order[0])
+        order.remove(partner)
+        played.add(frozenset((first, partner)))
+        pairs.append((first, partner))
+    return pairs, bye
+
+
+def run_matches(pool, tasks, chunksize):
+    # Матчи тура независимы и раздаются пулу пачками
+    if pool:
+        return list(pool.imap_unordered(play_match, tasks, chunksize))
+    return [play_match(task) for task in tasks]
+
+
+def summarize(matches, fps):
+    # Сводная статистика по ботам, длительности, очкам и времени тика
+    bots = {}
+    for m in matches:
+        for seat, name, own, other in ((1, m["bot1"], m["score1"], m["score2"]),
+                                       (2, m["bot2"], m["score2"], m["score1"])):
+            b = bots.setdefault(name, {"matches": 0, "wins": 0, "losses": 0, "draws": 0,
+                                       "timeouts": 0, "score": 0, "score_against": 0})
+            b["matches"] += 1
+            b["score"] += own
+            b["score_against"] += other
+            if m["result"] == str(seat):
+                b["wins"] += 1
+            elif m["result"] in ("1", "2"):
+                b["losses"] += 1
+            elif m["result"] == "draw":
+                b["draws"] += 1
+            else:
+                b["timeouts"] += 1
+    for b in bots.values():
+        b["win_rate"] = b["wins"] / b["matches"]
+        b["avg_score"] = b["score"] / b["matches"]
+
+    tick_hist = {}
+    for m in matches:
+        for us, count in m["tick_us"].items():
+            tick_hist[us] = tick_hist.get(us, 0) + count
+    total_ticks = sum(m["ticks"] for m in matches)
+    results = {}
+    for m in matches:
+        results[m["result"]] = results.get(m["result"], 0) + 1
+    return {
+        "bots": dict(sorted(bots.items(), key=lambda item: -item[1]["win_rate"])),
+        "results": results,
+        "seat1_win_rate": results.get("1", 0) / len(matches),
+        "match_ticks": percentiles([m["ticks"] for m in matches]),
+        "match_seconds_at_fps": percentiles([m["ticks"] / fps for m in matches]),
+        "scores": percentiles([m["score1"] + m["score2"] for m in matches]),
+        "tick_us": histogram_percentiles(tick_hist),
+        "bot_us_per_tick": sum(m["bot_ns"] for m in matches) / max(total_ticks, 1) / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Турнир ботов на правилах сервера без окна и сети")
+    parser.add_argument("--bots", default=",".join(BOTS), help=f"боты через запятую: {', '.join(BOTS)}")
+    parser.add_argument("--format", choices=["round-robin", "swiss"], default="round-robin")
+    parser.add_argument("--rounds", type=int, default=10, help="кругов (round-robin) или туров (swiss)")
+    parser.add_argument("--games", type=int, default=1, help="матчей на пару в туре swiss")
+    parser.add_argument("--board", help="размер поля в клетках, например 40x30 (как SNAKE_BOARD)")
+    parser.add_argument("--fps", type=int, default=snake.FPS, help="частота тиков для пересчета длительности")
+    parser.add_argument("--spawn", choices=["random", "mirrored"], default="random")
+    parser.add_argument("--max-ticks", type=int, default=20000, help="лимит тиков одного матча")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="число рабочих процессов")
+    parser.add_argument("--chunksize", type=int, default=8, help="матчей в одной пачке для процесса")
+    parser.add_argument("--matches", action="store_true", help="сохранить в файл и каждый матч")
+    parser.add_argument("--output", default="tournament.json", help="файл результатов")
+    args = parser.parse_args()
+
+    bots = [b.strip() for b in args.bots.split(",") if b.strip()]
+    unknown = [b for b in bots if b not in BOTS]
+    if unknown or len(bots) < 2:
+        print(f"Нужно не меньше двух ботов из: {', '.join(BOTS)}", file=sys.stderr)
+        return 1
+
+    # Пул закрывается через close/join: SDL перехватывает SIGTERM от terminate()
+    pool = Pool(args.workers) if args.workers > 1 else None
+    started = time.perf_counter()
+    matches = []
+    if args.format == "round-robin":
+        tasks = [t for tour in round_robin(bots, args.rounds, args.seed, args.spawn, args.max_ticks) for t in tour]
+        matches = run_matches(pool, tasks, args.chunksize)
+    else:
+        points = {b: 0 for b in bots}
+        played = set()
+        byes = {}
+        for tour in range(args.rounds):
+            pairs, bye = swiss_pairs(bots, points, played, byes)
+            if bye:
+                # Бай стоит столько же, сколько победы во всех матчах тура
+                points[bye] += 2 * args.games
+                byes[bye] = byes.get(bye, 0) + 1
+            tasks = []
+            for a, b in pairs:
+                for g in range(args.games):
+                    match_id = len(matches) + len(tasks)
+                    # Стартовые позиции чередуются, чтобы не давать преимущество первому
+                    first, second = (a, b) if g % 2 == 0 else (b, a)
+                    tasks.append((match_id, first, second, args.seed + match_id, args.spawn, args.max_ticks))
+            results = run_matches(pool, tasks, args.chunksize)
+            for m in results:
+                if m["result"] in ("1", "2"):
+                    points[m["bot" + m["result"]]] += 2
+                else:
+                    points[m["bot1"]] += 1
+                    points[m["bot2"]] += 1
+            matches.extend(results)
+    if pool:
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - started
+
+    matches.sort(key=lambda m: m["id"])
+    summary = summarize(matches, args.fps)
+    report = {
+        "config": {
+            "format": args.format,
+            "bots": bots,
+            "rounds": args.rounds,
+            "board": [snake.BOARD_WIDTH // snake.SNAKE_BLOCK,
+                      (snake.BOARD_HEIGHT - snake.GAME_AREA_TOP) // snake.SNAKE_BLOCK],
+            "fps": args.fps,
+            "spawn": args.spawn,
+            "max_ticks": args.max_ticks,
+            "seed": args.seed,
+            "workers": args.workers,
+        },
+        "matches_played": len(matches),
+        "elapsed_s": elapsed,
+        "matches_per_s": len(matches) / max(elapsed, 1e-9),
+        **summary,
+    }
+    if args.format == "swiss":
+        report["standings"] = dict(sorted(points.items(), key=lambda item: -item[1]))
+        report["byes"] = byes
+    if args.matches:
+        report["matches"] = [{k: v for k, v in m.items() if k != "tick_us"} for m in matches]
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"Матчей: {len(matches)} за {elapsed:.2f} с ({report['matches_per_s']:.0f} в секунду), "
+          f"процессов {args.workers}; результаты в {args.output}", file=sys.stderr)
+    for name, b in summary["bots"].items():
+        print(f"  {name:10} побед {b['win_rate']:6.1%}  очков в среднем {b['avg_score']:.2f}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())